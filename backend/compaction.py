@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, IndexModel
+
+from log import get_logger
+from metrics import registry
+
+logger = get_logger("compaction")
+
+# Dislikes older than the retention window are folded out of `interactions`
+# into per-user lists of targets in `interaction_archive`:
+# {user_id, targets: [user_id, ...], count, created_at}. They only ever serve
+# to keep a candidate out of search and received likes, so the target id is
+# all that is kept. Likes and super likes stay as they are; matches need them.
+ARCHIVE_COLLECTION = "interaction_archive"
+COMPACTION_ENABLED = os.environ.get('COMPACTION_ENABLED', 'true').lower() == 'true'
+DISLIKE_RETENTION_DAYS = float(os.environ.get('DISLIKE_RETENTION_DAYS', 30))
+# Optional TTL on raw dislikes as a backstop if the job falls behind (0 = off).
+# Never shorter than the retention window plus a week, so the job gets there
+# first, and refused while compaction is disabled: expiring unarchived
+# dislikes would put those users back in search. Applied on every startup.
+DISLIKE_TTL_DAYS = float(os.environ.get('DISLIKE_TTL_DAYS', 0))
+COMPACTION_INTERVAL = float(os.environ.get('COMPACTION_INTERVAL', 3600))
+COMPACTION_BATCH_SIZE = int(os.environ.get('COMPACTION_BATCH_SIZE', 1000))
+# Targets per archive document, keeping each well under the 16MB document limit
+ARCHIVE_BUCKET_SIZE = int(os.environ.get('ARCHIVE_BUCKET_SIZE', 1000))
+
+
+DISLIKE_INDEX = "dislike_timestamp"
+
+
+def dislike_ttl_seconds():
+    if not DISLIKE_TTL_DAYS or not COMPACTION_ENABLED:
+        return None
+    return int(max(DISLIKE_TTL_DAYS, DISLIKE_RETENTION_DAYS + 7) * 86400)
+
+
+def dislike_index(ttl):
+    """The compaction scan's partial index over dislikes, expiring them when ttl is set."""
+    options = {"expireAfterSeconds": ttl} if ttl else {}
+    return IndexModel(
+        [("timestamp", ASCENDING)], partialFilterExpression={"action": "dislike"}, name=DISLIKE_INDEX, **options
+    )
+
+
+async def reconcile_dislike_ttl(db):
+    """Bring the dislike index's TTL in line with the current settings; returns the TTL in force."""
+    if DISLIKE_TTL_DAYS and not COMPACTION_ENABLED:
+        logger.error("DISLIKE_TTL_DAYS is ignored while COMPACTION_ENABLED is false", extra={"event": "dislike_ttl_refused"})
+    wanted = dislike_ttl_seconds()
+    index = (await db.interactions.index_information()).get(DISLIKE_INDEX)
+    if index is None:
+        # Created by migration 11, which reads the same settings
+        return None
+    current = index.get("expireAfterSeconds")
+    if current == wanted:
+        return current
+
+    if current is not None and wanted is not None:
+        await db.command({"collMod": "interactions", "index": {"name": DISLIKE_INDEX, "expireAfterSeconds": wanted}})
+    else:
+        # collMod can't turn TTL on or off on every server version, so rebuild the index
+        await db.interactions.drop_index(DISLIKE_INDEX)
+        await db.interactions.create_indexes([dislike_index(wanted)])
+    logger.info("Dislike TTL %s -> %s", current, wanted, extra={"event": "dislike_ttl_changed"})
+    return wanted
+
+
+async def archived_targets(db, user_id, candidate_ids):
+    """The subset of candidate_ids that user_id's archived dislikes contain."""
+    if not candidate_ids:
+        return set()
+    archived = await db[ARCHIVE_COLLECTION].aggregate([
+        {"$match": {"user_id": user_id, "targets": {"$in": list(candidate_ids)}}},
+        {"$project": {"_id": 0, "targets": {
+            "$filter": {"input": "$targets", "as": "target", "cond": {"$in": ["$$target", list(candidate_ids)]}}
+        }}}
+    ])
+    return {target for bucket in archived for target in bucket["targets"]}
+
+
+async def archived_by(db, user_ids, target_user_id):
+    """The subset of user_ids with an archived dislike of target_user_id."""
+    buckets = await db[ARCHIVE_COLLECTION].find(
+        {"user_id": {"$in": list(user_ids)}, "targets": target_user_id}, {"_id": 0, "user_id": 1}
+    )
+    return {bucket["user_id"] for bucket in buckets}
+
+
+async def all_archived_targets(db, user_id):
+    buckets = await db[ARCHIVE_COLLECTION].find({"user_id": user_id}, {"_id": 0, "targets": 1})
+    return [target for bucket in buckets for target in bucket["targets"]]
+
+
+async def _archive(db, user_id, targets):
+    """Append targets to the user's buckets, filling the open one before starting another.
+
+    count always equals the size of targets: each write adds only targets the
+    bucket lacks, no more than it has room for, and only if the bucket is
+    unchanged since it was read.
+    """
+    # A re-run after an interrupted pass finds some targets archived already
+    archived = await archived_targets(db, user_id, targets)
+    targets = [target for target in dict.fromkeys(targets) if target not in archived]
+    while targets:
+        bucket = await db[ARCHIVE_COLLECTION].find_one(
+            {"user_id": user_id, "count": {"$lt": ARCHIVE_BUCKET_SIZE}}, {"targets": 1, "count": 1}
+        )
+        if bucket is None:
+            chunk = targets[:ARCHIVE_BUCKET_SIZE]
+            await db[ARCHIVE_COLLECTION].insert_one(
+                {"user_id": user_id, "targets": chunk, "count": len(chunk), "created_at": datetime.now()}
+            )
+        else:
+            present = set(bucket["targets"])
+            targets = [target for target in targets if target not in present]
+            chunk = targets[:ARCHIVE_BUCKET_SIZE - bucket["count"]]
+            if not chunk:
+                continue
+            result = await db[ARCHIVE_COLLECTION].update_one(
+                {"_id": bucket["_id"], "count": bucket["count"]},
+                {"$push": {"targets": {"$each": chunk}}, "$inc": {"count": len(chunk)}}
+            )
+            if not result.modified_count:
+                # Another compactor wrote to it meanwhile; read it again
+                continue
+        targets = targets[len(chunk):]
+
+
+async def compact_dislikes(db, cutoff=None, batch_size=COMPACTION_BATCH_SIZE):
+    """Move dislikes older than cutoff into the archive; returns how many were moved."""
+    cutoff = cutoff or datetime.now() - timedelta(days=DISLIKE_RETENTION_DAYS)
+    moved = 0
+    while True:
+        batch = await db.interactions.find(
+            {"action": "dislike", "timestamp": {"$lt": cutoff}},
+            {"_id": 1, "user_id": 1, "target_user_id": 1},
+            limit=batch_size
+        )
+        if not batch:
+            return moved
+
+        by_user = {}
+        for interaction in batch:
+            by_user.setdefault(interaction["user_id"], []).append(interaction["target_user_id"])
+        for user_id, targets in by_user.items():
+            await _archive(db, user_id, targets)
+
+        # Archived before deleting, so an interrupted pass leaves both rather than
+        # neither. A dislike re-swiped since it was read no longer matches and stays.
+        result = await db.interactions.delete_many({
+            "_id": {"$in": [interaction["_id"] for interaction in batch]},
+            "action": "dislike",
+            "timestamp": {"$lt": cutoff}
+        })
+        moved += result.deleted_count
+        registry.inc("gora_interactions_compacted_total", "Dislikes folded into the interaction archive", {}, result.deleted_count)
+        if len(batch) < batch_size:
+            return moved
+
+
+class InteractionCompactor:
+    """Background task that compacts old dislikes every COMPACTION_INTERVAL seconds."""
+
+    def __init__(self, db, interval=COMPACTION_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self._task = None
+        self.runs = 0
+        self.moved = 0
+        self.failed = 0
+        self.last_run_at = None
+
+    async def start(self):
+        try:
+            await reconcile_dislike_ttl(self.db)
+        except Exception:
+            logger.exception("Dislike TTL reconcile error")
+        if COMPACTION_ENABLED:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                moved = await compact_dislikes(self.db)
+                self.runs += 1
+                self.moved += moved
+                self.last_run_at = datetime.now()
+                if moved:
+                    logger.info("Compacted %s dislikes", moved, extra={"event": "dislikes_compacted", "moved": moved})
+            except Exception:
+                self.failed += 1
+                logger.exception("Compaction error")
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "moved": self.moved,
+            "failed": self.failed,
+            "last_run_at": self.last_run_at
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fold old dislikes into the interaction archive once")
+    parser.add_argument("--days", type=float, default=DISLIKE_RETENTION_DAYS, help="retention window in days")
+    args = parser.parse_args()
+
+    import database
+
+    async def main():
+        moved = await compact_dislikes(database.db, datetime.now() - timedelta(days=args.days))
+        print(f"✅ Archived {moved} dislikes")
+        database.close()
+
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo import MongoClient
+from pymongo.errors import ExecutionTimeout
+
+from health import pool_stats
+from metrics import command_listener
+
+# MongoDB connection settings
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+MONGO_DB_NAME = os.environ.get('MONGO_DB_NAME', 'dating_app')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+
+# Per-operation timeout in seconds, applied to every call made through AsyncCollection
+MONGO_OP_TIMEOUT = float(os.environ.get('MONGO_OP_TIMEOUT', 5))
+
+# Worker threads that run blocking driver calls; more threads than pooled
+# connections would only queue inside the driver, so default to the pool size
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', MONGO_MAX_POOL_SIZE))
+
+
+def _timed_call(fn, op_timeout):
+    """Wrap fn to run under the part of op_timeout left once a worker thread picks it up.
+
+    The deadline is taken now, at submission, so time spent queued behind a
+    saturated executor counts against it; a call that expired while queued
+    fails without touching the server.
+    """
+    deadline = time.monotonic() + op_timeout
+
+    def call():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ExecutionTimeout("operation timed out waiting for a database worker", 50)
+        # pymongo.timeout bounds the whole call, including cursor iteration
+        with pymongo.timeout(remaining):
+            return fn()
+
+    return call
+
+
+class AsyncCollection:
+    """Runs pymongo collection calls on a bounded executor so they never block the event loop."""
+
+    def __init__(self, collection, executor, timeout):
+        self.collection = collection
+        self.name = collection.name
+        self._executor = executor
+        self._timeout = timeout
+
+    async def _run(self, fn, *args, timeout=None, **kwargs):
+        op_timeout = self._timeout if timeout is None else timeout
+        call = _timed_call(lambda: fn(*args, **kwargs), op_timeout)
+
+        # Carry the caller's context into the thread so the command listener
+        # can attribute the call to the request that made it
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, contextvars.copy_context().run, call)
+
+    async def find_one(self, filter=None, projection=None, sort=None, timeout=None):
+        return await self._run(self.collection.find_one, filter, projection, sort=sort, timeout=timeout)
+
+    async def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, timeout=None):
+        def fetch():
+            cursor = self.collection.find(filter, projection, sort=sort, skip=skip, limit=limit)
+            return list(cursor)
+
+        return await self._run(fetch, timeout=timeout)
+
+    async def count_documents(self, filter, timeout=None, **kwargs):
+        return await self._run(self.collection.count_documents, filter, timeout=timeout, **kwargs)
+
+    async def aggregate(self, pipeline, timeout=None, **kwargs):
+        def fetch():
+            return list(self.collection.aggregate(pipeline, **kwargs))
+
+        return await self._run(fetch, timeout=timeout)
+
+    async def insert_one(self, document, timeout=None):
+        return await self._run(self.collection.insert_one, document, timeout=timeout)
+
+    async def insert_many(self, documents, ordered=True, timeout=None):
+        return await self._run(self.collection.insert_many, documents, ordered=ordered, timeout=timeout)
+
+    async def update_one(self, filter, update, upsert=False, timeout=None, **kwargs):
+        return await self._run(self.collection.update_one, filter, update, upsert=upsert, timeout=timeout, **kwargs)
+
+    async def update_many(self, filter, update, upsert=False, timeout=None, **kwargs):
+        return await self._run(self.collection.update_many, filter, update, upsert=upsert, timeout=timeout, **kwargs)
+
+    async def replace_one(self, filter, replacement, upsert=False, timeout=None):
+        return await self._run(self.collection.replace_one, filter, replacement, upsert=upsert, timeout=timeout)
+
+    async def find_one_and_update(self, filter, update, timeout=None, **kwargs):
+        return await self._run(self.collection.find_one_and_update, filter, update, timeout=timeout, **kwargs)
+
+    async def delete_many(self, filter, timeout=None):
+        return await self._run(self.collection.delete_many, filter, timeout=timeout)
+
+    async def bulk_write(self, requests, ordered=True, timeout=None):
+        return await self._run(self.collection.bulk_write, requests, ordered=ordered, timeout=timeout)
+
+    async def create_indexes(self, indexes, timeout=None):
+        return await self._run(self.collection.create_indexes, indexes, timeout=timeout)
+
+    async def drop_index(self, index_name, timeout=None):
+        return await self._run(self.collection.drop_index, index_name, timeout=timeout)
+
+    async def index_information(self, timeout=None):
+        return await self._run(self.collection.index_information, timeout=timeout)
+
+
+class AsyncDatabase:
+    """Attribute-style access to AsyncCollection wrappers, mirroring pymongo's Database."""
+
+    def __init__(self, database, executor, timeout):
+        self.database = database
+        self._executor = executor
+        self._timeout = timeout
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = AsyncCollection(self.database[name], self._executor, self._timeout)
+            self._collections[name] = collection
+        return collection
+
+    async def command(self, command, timeout=None):
+        op_timeout = self._timeout if timeout is None else timeout
+        call = _timed_call(lambda: self.database.command(command), op_timeout)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, contextvars.copy_context().run, call)
+
+
+def create_client():
+    return MongoClient(
+        MONGO_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        event_listeners=[command_listener, pool_stats],
+    )
+
+
+client = create_client()
+executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+db = AsyncDatabase(client[MONGO_DB_NAME], executor, MONGO_OP_TIMEOUT)
+
+
+def close():
+    executor.shutdown(wait=True)
+    client.close()
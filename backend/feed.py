@@ -0,0 +1,157 @@
+import asyncio
+import os
+from datetime import datetime
+
+from pymongo import ReturnDocument
+
+from log import get_logger
+from pagination import keyset_filter, sort_spec
+from ranking import rank_candidates
+from seen_filter import filter_unseen, load_seen_filter
+from user_cache import USER_CACHE_PROJECTION
+
+logger = get_logger("feed")
+
+# Precomputed, ranked candidate queues for the ranked search feed.
+# Collection: feed_queues {_id: user_id, queue: [user_id, ...], scan_key, built_at}
+FEED_ENABLED = os.environ.get('FEED_ENABLED', 'true').lower() == 'true'
+FEED_QUEUE_SIZE = int(os.environ.get('FEED_QUEUE_SIZE', 100))
+# Refill once a pop leaves fewer than this many candidates queued
+FEED_LOW_WATERMARK = int(os.environ.get('FEED_LOW_WATERMARK', 30))
+# Candidates looked at per refill; the scan resumes where the last one stopped
+FEED_SCAN_LIMIT = int(os.environ.get('FEED_SCAN_LIMIT', 1000))
+FEED_BATCH_SIZE = int(os.environ.get('FEED_BATCH_SIZE', 200))
+FEED_BUILD_CONCURRENCY = int(os.environ.get('FEED_BUILD_CONCURRENCY', 2))
+# Queues are dropped (TTL index) this long after they were first built, so rankings never go stale for long
+FEED_MAX_AGE = int(os.environ.get('FEED_MAX_AGE', 3600))
+
+# Same keyset order as search_users, served by the active_gender_created_user index
+SCAN_SORT_FIELDS = ["created_at", "user_id"]
+SCAN_PROJECTION = {"_id": 0, "user_id": 1, "age": 1, "selected_spokies": 1, "relationship_type": 1, "created_at": 1}
+
+
+def candidate_query(user):
+    """Who a user may be shown: other active users of the genders they are interested in."""
+    query = {"telegram_id": {"$ne": user["telegram_id"]}, "is_active": True}
+    if user.get("interested_in"):
+        query["gender"] = {"$in": user["interested_in"]}
+    return query
+
+
+async def build_feed(db, user_id):
+    """Top up a user's queue with the best-ranked unseen candidates not already queued."""
+    user = await db.users.find_one({"user_id": user_id}, USER_CACHE_PROJECTION)
+    if not user:
+        return 0
+
+    state = await db.feed_queues.find_one({"_id": user_id}, {"queue": 1, "scan_key": 1}) or {}
+    queued = set(state.get("queue", []))
+    needed = FEED_QUEUE_SIZE - len(queued)
+    if needed <= 0:
+        return 0
+
+    seen = await load_seen_filter(db, user_id)
+    query = candidate_query(user)
+    scan_key = state.get("scan_key")
+    candidates = []
+    scanned = 0
+    while scanned < FEED_SCAN_LIMIT:
+        batch_query = dict(query)
+        if scan_key:
+            batch_query.update(keyset_filter(SCAN_SORT_FIELDS, scan_key))
+        batch = await db.users.find(batch_query, SCAN_PROJECTION, sort=sort_spec(SCAN_SORT_FIELDS), limit=FEED_BATCH_SIZE)
+        scanned += len(batch)
+
+        if batch:
+            unseen = await filter_unseen(db, user_id, seen, [c["user_id"] for c in batch])
+            candidates += [c for c in batch if c["user_id"] in unseen and c["user_id"] not in queued]
+            scan_key = [batch[-1][field] for field in SCAN_SORT_FIELDS]
+        if len(batch) < FEED_BATCH_SIZE:
+            # Reached the newest user; the next refill starts over, picking up
+            # candidates that were served but never swiped
+            scan_key = None
+            break
+
+    ranked = [c["user_id"] for c in rank_candidates(user, candidates, needed)]
+    now = datetime.now()
+    await db.feed_queues.update_one(
+        {"_id": user_id},
+        {
+            "$push": {"queue": {"$each": ranked}},
+            "$set": {"scan_key": scan_key, "refilled_at": now},
+            "$setOnInsert": {"built_at": now}
+        },
+        upsert=True
+    )
+    return len(ranked)
+
+
+async def pop_feed(db, user_id, count):
+    """Atomically take the first count queued ids; returns (ids, remaining)."""
+    state = await db.feed_queues.find_one_and_update(
+        {"_id": user_id, "queue.0": {"$exists": True}},
+        [{"$set": {"queue": {"$slice": ["$queue", count, FEED_QUEUE_SIZE]}}}],
+        projection={"queue": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not state:
+        return [], 0
+    return state["queue"][:count], max(len(state["queue"]) - count, 0)
+
+
+async def hydrate_feed(db, user_id, ids, projection):
+    """Load queued candidates in queue order, dropping ones swiped or deactivated since queueing."""
+    users = await db.users.find({"user_id": {"$in": ids}, "is_active": True}, projection)
+    seen = await load_seen_filter(db, user_id)
+    unseen = await filter_unseen(db, user_id, seen, [u["user_id"] for u in users]) if users else set()
+    by_id = {u["user_id"]: u for u in users if u["user_id"] in unseen}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+class FeedBuilder:
+    """Background asyncio workers that refill queues for users whose feed ran low."""
+
+    def __init__(self, db, concurrency=FEED_BUILD_CONCURRENCY):
+        self.db = db
+        self.concurrency = concurrency
+        self._pending = None
+        self._requested = set()
+        self._tasks = []
+        self.built = 0
+        self.failed = 0
+
+    async def start(self):
+        # Created here so it binds to the server's event loop
+        self._pending = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def request(self, user_id):
+        """Schedule a refill; repeated requests for a user already waiting are ignored."""
+        if self._pending is None or user_id in self._requested:
+            return
+        self._requested.add(user_id)
+        self._pending.put_nowait(user_id)
+
+    async def _work(self):
+        while True:
+            user_id = await self._pending.get()
+            try:
+                await build_feed(self.db, user_id)
+                self.built += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Feed build error", extra={"user_id": user_id})
+            finally:
+                self._requested.discard(user_id)
+
+    def stats(self):
+        return {
+            "pending": self._pending.qsize() if self._pending else 0,
+            "built": self.built,
+            "failed": self.failed
+        }
@@ -0,0 +1,204 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime
+
+from pymongo import monitoring
+
+from log import get_logger
+
+logger = get_logger("health")
+
+# The readiness probe only reads state kept here; MongoDB is pinged in the
+# background every HEALTH_PING_INTERVAL seconds, never per probe
+HEALTH_PING_INTERVAL = float(os.environ.get('HEALTH_PING_INTERVAL', 5))
+HEALTH_PING_TIMEOUT = float(os.environ.get('HEALTH_PING_TIMEOUT', 2))
+# A ping result older than this counts as failed, e.g. if the pinger is stuck
+HEALTH_MAX_STALENESS = float(os.environ.get('HEALTH_MAX_STALENESS', 15))
+HEALTH_LAG_INTERVAL = float(os.environ.get('HEALTH_LAG_INTERVAL', 0.5))
+# Event-loop lag above this takes the instance out of rotation until it recovers; 0 disables
+HEALTH_MAX_LOOP_LAG = float(os.environ.get('HEALTH_MAX_LOOP_LAG', 1))
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool usage, summed over the servers the client talks to; updated from driver threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.checkout_failures = 0
+        self.cleared = 0
+
+    def _add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, in_use=1)
+
+    def connection_checked_in(self, event):
+        self._add(in_use=-1)
+
+    def snapshot(self, max_size):
+        with self._lock:
+            return {
+                "max_size": max_size,
+                "open": self.open,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "utilization": round(self.in_use / max_size, 3) if max_size else None,
+                "checkout_failures": self.checkout_failures,
+                "cleared": self.cleared
+            }
+
+
+pool_stats = PoolStats()
+
+
+class HealthMonitor:
+    """Background tasks that keep a cached MongoDB ping result and sample event-loop lag.
+
+    With schema_version (an async fn of db) and expected_schema, readiness also
+    waits for the database schema to be current; until it is, the recorded
+    version is re-read on every ping, e.g. while another instance migrates.
+    """
+
+    def __init__(self, db, schema_version=None, expected_schema=None):
+        self.db = db
+        self._schema_version = schema_version
+        self.expected_schema = expected_schema
+        self.schema = None
+        self.schema_error = None
+        self._tasks = []
+        self.started = False
+        self.stopping = False
+        self.ping_ok = False
+        self.ping_ms = None
+        self.pinged_at = None
+        self.ping_error = None
+        self.ping_failures = 0
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._ping_loop()), asyncio.create_task(self._lag_loop())]
+
+    def mark_started(self):
+        """Called once the app has finished starting up; readiness stays false until then."""
+        self.started = True
+
+    async def close(self):
+        # Fail readiness first so the orchestrator stops routing here while we drain
+        self.stopping = True
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def ping(self):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.db.command({"ping": 1}, timeout=HEALTH_PING_TIMEOUT), HEALTH_PING_TIMEOUT)
+        except Exception as error:
+            if self.ping_ok or self.pinged_at is None:
+                logger.warning("MongoDB ping failed", extra={"event": "db_ping_failed", "error": repr(error)})
+            self.ping_ok = False
+            self.ping_error = repr(error)
+            self.ping_failures += 1
+        else:
+            if not self.ping_ok and self.pinged_at is not None:
+                logger.info("MongoDB ping recovered", extra={"event": "db_ping_recovered"})
+            self.ping_ok = True
+            self.ping_error = None
+        self.ping_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.pinged_at = time.monotonic()
+
+    def set_schema(self, version, error=None):
+        self.schema = version
+        self.schema_error = error
+
+    def schema_ok(self):
+        # A newer schema is fine: rolling deploys migrate before old instances stop
+        return self._schema_version is None or (self.schema is not None and self.schema >= self.expected_schema)
+
+    async def _ping_loop(self):
+        while True:
+            await self.ping()
+            if self.ping_ok and not self.schema_ok():
+                try:
+                    self.schema = await self._schema_version(self.db)
+                    if self.schema_ok():
+                        self.schema_error = None
+                except Exception as error:
+                    self.schema_error = repr(error)
+            await asyncio.sleep(HEALTH_PING_INTERVAL)
+
+    async def _lag_loop(self):
+        # How late a short sleep wakes up is how long other callbacks held the loop
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(HEALTH_LAG_INTERVAL)
+            self.loop_lag = max(time.perf_counter() - before - HEALTH_LAG_INTERVAL, 0.0)
+            self.loop_lag_max = max(self.loop_lag_max, self.loop_lag)
+
+    def database_ok(self):
+        fresh = self.pinged_at is not None and time.monotonic() - self.pinged_at <= HEALTH_MAX_STALENESS
+        return self.ping_ok and fresh
+
+    def readiness(self, in_flight, max_pool_size):
+        """(ready, report) from cached state only."""
+        lag_ok = not HEALTH_MAX_LOOP_LAG or self.loop_lag <= HEALTH_MAX_LOOP_LAG
+        checks = {
+            "started": self.started and not self.stopping,
+            "database": self.database_ok(),
+            "schema": self.schema_ok(),
+            "event_loop": lag_ok
+        }
+        ready = all(checks.values())
+        report = {
+            "status": "ready" if ready else "not_ready",
+            "checks": checks,
+            "database": {
+                "ping_ms": self.ping_ms,
+                "last_ping_age_s": round(time.monotonic() - self.pinged_at, 1) if self.pinged_at is not None else None,
+                "error": self.ping_error,
+                "failures": self.ping_failures
+            },
+            "schema": {"version": self.schema, "expected": self.expected_schema, "error": self.schema_error},
+            "pool": pool_stats.snapshot(max_pool_size),
+            "in_flight_requests": in_flight,
+            "event_loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "event_loop_lag_max_ms": round(self.loop_lag_max * 1000, 1),
+            "timestamp": datetime.now()
+        }
+        return ready, report
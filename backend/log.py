@@ -0,0 +1,155 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Records waiting for the writer thread; beyond this they are dropped, never waited on
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Keep-rates by event name or level, e.g. "photo_saved=0.1,DEBUG=0.01".
+# Warnings and errors are always kept.
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'photo_saved=0.1,files_received=0.1')
+
+# Set per request by RequestIdMiddleware and attached to every record
+request_id = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "event"}
+
+
+def _parse_rates(text):
+    rates = {}
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        name, _, rate = part.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra= fields become top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "event", None):
+            entry["event"] = record.event
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key != "request_id":
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of records from noisy events or levels."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None), self.rates.get(record.levelname, 1.0))
+        return rate >= 1.0 or random.random() < rate
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Hands records to the writer thread without ever blocking the caller."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only freeze the message here; JSON and tracebacks are formatted on the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        record.request_id = request_id.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+logger = logging.getLogger("gora")
+_handler = None
+_output = None
+_listener = None
+
+
+def get_logger(name):
+    return logger.getChild(name)
+
+
+def configure(stream=None):
+    """Route the app's loggers through a bounded queue to a JSON writer thread."""
+    global _handler, _output, _listener
+    if _listener is not None:
+        return
+
+    if _handler is None:
+        _output = logging.StreamHandler(stream or sys.stdout)
+        _output.setFormatter(JsonFormatter())
+        _handler = BoundedQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        _handler.addFilter(SamplingFilter(_parse_rates(LOG_SAMPLE_RATES)))
+        logger.addHandler(_handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+
+    _listener = QueueListener(_handler.queue, _output, respect_handler_level=False)
+    _listener.start()
+
+
+def shutdown():
+    """Flush what is queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_count():
+    return _handler.dropped if _handler else 0
+
+
+class RequestIdMiddleware:
+    """Tags each HTTP request with an id, taken from X-Request-ID or generated, and echoes it back."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:64]
+        current = incoming or uuid.uuid4().hex
+        token = request_id.set(current)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", current.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
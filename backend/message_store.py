@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from log import get_logger
+from pagination import BACKWARD, FORWARD, keyset_filter, sort_spec
+
+logger = get_logger("message_store")
+
+# "documents" stores one document per message in `messages`; "bucketed" appends
+# them to fixed-size per-chat documents in `message_buckets`. The mode applies
+# to chats created from now on; existing chats are converted with
+# `python message_store.py --all`. Each chat records its mode in chats.storage.
+MESSAGE_STORAGE = os.environ.get('MESSAGE_STORAGE', 'documents')
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', 100))
+# Pause before a conversion's final catch-up pass, for sends already in flight;
+# longer than MONGO_OP_TIMEOUT plus executor queueing so those have landed
+MESSAGE_MIGRATION_GRACE = float(os.environ.get('MESSAGE_MIGRATION_GRACE', 15))
+
+# How often a "documents" server re-checks whether any chat has been bucketed
+# yet; until one has, history reads skip looking up the chat's storage mode
+MESSAGE_STORAGE_REFRESH = float(os.environ.get('MESSAGE_STORAGE_REFRESH', 5))
+
+BUCKETED = "bucketed"
+# {_id: "state", since} in message_storage, written before the first chat is bucketed
+STORAGE_STATE_ID = "state"
+MESSAGE_SORT_FIELDS = ["timestamp", "message_id"]
+BUCKET_MESSAGE_FIELDS = ("message_id", "sender_id", "message", "timestamp", "is_read")
+
+# Buckets: {_id: "<chat_id>:<seq>", chat_id, seq, count, first_timestamp,
+# last_timestamp, messages: [...]}, messages kept sorted by (timestamp, message_id).
+# chats.message_bucket points at the bucket currently being filled.
+
+
+def is_bucketed(chat):
+    return bool(chat) and chat.get("storage") == BUCKETED
+
+
+def bucket_id(chat_id, seq):
+    return f"{chat_id}:{seq}"
+
+
+def _key(message):
+    return tuple(message[field] for field in MESSAGE_SORT_FIELDS)
+
+
+async def _append_to_bucket(db, chat, message):
+    chat_id = chat["chat_id"]
+    entry = {field: message[field] for field in BUCKET_MESSAGE_FIELDS}
+    seq = chat.get("message_bucket", 0)
+    while True:
+        try:
+            await db.message_buckets.update_one(
+                {"_id": bucket_id(chat_id, seq), "count": {"$lt": MESSAGE_BUCKET_SIZE}},
+                {
+                    "$push": {"messages": {"$each": [entry], "$sort": {"timestamp": 1, "message_id": 1}}},
+                    "$inc": {"count": 1},
+                    "$min": {"first_timestamp": message["timestamp"]},
+                    "$max": {"last_timestamp": message["timestamp"]},
+                    "$setOnInsert": {"chat_id": chat_id, "seq": seq}
+                },
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            # The bucket exists but is full: move the chat on to the next one
+            seq += 1
+            await db.chats.update_one({"chat_id": chat_id}, {"$max": {"message_bucket": seq}})
+
+
+async def insert_message(db, chat, message):
+    if is_bucketed(chat):
+        await _append_to_bucket(db, chat, message)
+    else:
+        await db.messages.insert_one(message)
+
+
+async def read_messages(db, chat_id, chat, key=None, direction=FORWARD, skip=0, limit=50):
+    """A page of messages after (FORWARD) or before (BACKWARD) key, in that direction's order."""
+    if not is_bucketed(chat):
+        query = {"chat_id": chat_id}
+        if key is not None:
+            query.update(keyset_filter(MESSAGE_SORT_FIELDS, key, direction))
+        return await db.messages.find(query, sort=sort_spec(MESSAGE_SORT_FIELDS, direction), skip=skip, limit=limit)
+
+    # A bucket's timestamp range bounds what it can hold, so the page lies in the
+    # nearest buckets on the key's side; one extra covers a partly used first bucket
+    query = {"chat_id": chat_id}
+    if direction == BACKWARD:
+        if key is not None:
+            query["first_timestamp"] = {"$lte": key[0]}
+        sort = [("first_timestamp", -1)]
+    else:
+        if key is not None:
+            query["last_timestamp"] = {"$gte": key[0]}
+        sort = [("last_timestamp", 1)]
+    buckets = await db.message_buckets.find(
+        query, {"messages": 1}, sort=sort, limit=(skip + limit) // MESSAGE_BUCKET_SIZE + 2
+    )
+
+    messages = [message for bucket in buckets for message in bucket["messages"]]
+    if key is not None:
+        key = tuple(key)
+        messages = [m for m in messages if (_key(m) < key if direction == BACKWARD else _key(m) > key)]
+    messages.sort(key=_key, reverse=direction == BACKWARD)
+
+    page = messages[skip:skip + limit]
+    for message in page:
+        message["chat_id"] = chat_id
+    return page
+
+
+async def find_message_key(db, chat, message_id):
+    """The (timestamp, message_id) sort key of one message, as a dict; None if not in this chat."""
+    chat_id = chat["chat_id"]
+    if not is_bucketed(chat):
+        return await db.messages.find_one(
+            {"chat_id": chat_id, "message_id": message_id}, {"_id": 0, "timestamp": 1, "message_id": 1}
+        )
+    bucket = await db.message_buckets.find_one(
+        {"chat_id": chat_id, "messages.message_id": message_id},
+        {"messages": {"$elemMatch": {"message_id": message_id}}}
+    )
+    if not bucket:
+        return None
+    return {field: bucket["messages"][0][field] for field in MESSAGE_SORT_FIELDS}
+
+
+async def newest_message_key(db, chat):
+    newest = await read_messages(db, chat["chat_id"], chat, direction=BACKWARD, limit=1)
+    if not newest:
+        return None
+    return {field: newest[0][field] for field in MESSAGE_SORT_FIELDS}
+
+
+async def mark_read(db, chat, user_id, upto, since=None):
+    """Flip is_read on the other participants' messages up to upto; returns how many were flipped.
+
+    since is the reader's previous watermark, which bounds the buckets to look at.
+    """
+    chat_id = chat["chat_id"]
+    if not is_bucketed(chat):
+        result = await db.messages.update_many(
+            {
+                "chat_id": chat_id,
+                "is_read": False,
+                "timestamp": {"$lte": upto["timestamp"]},
+                "sender_id": {"$ne": user_id}
+            },
+            {"$set": {"is_read": True}}
+        )
+        return result.modified_count
+
+    unread = {"is_read": False, "sender_id": {"$ne": user_id}, "timestamp": {"$lte": upto["timestamp"]}}
+    query = {"chat_id": chat_id, "first_timestamp": {"$lte": upto["timestamp"]}, "messages": {"$elemMatch": unread}}
+    if since:
+        query["last_timestamp"] = {"$gte": since["timestamp"]}
+    buckets = await db.message_buckets.find(query, {"_id": 1})
+
+    async def flip(bucket):
+        # Count from each bucket's own atomic write: a concurrent mark-read
+        # sees these messages already read in its before-image and counts none
+        before = await db.message_buckets.find_one_and_update(
+            {"_id": bucket["_id"], "messages": {"$elemMatch": unread}},
+            {"$set": {"messages.$[m].is_read": True}},
+            array_filters=[{f"m.{field}": condition for field, condition in unread.items()}],
+            projection={"messages.timestamp": 1, "messages.sender_id": 1, "messages.is_read": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not before:
+            return 0
+        return sum(
+            1
+            for m in before["messages"]
+            if not m["is_read"] and m["sender_id"] != user_id and m["timestamp"] <= upto["timestamp"]
+        )
+
+    return sum(await asyncio.gather(*(flip(bucket) for bucket in buckets)))
+
+
+async def _catch_up(db, chat):
+    """Move what is left in `messages` for a bucketed chat into its buckets; returns how many went.
+
+    Only the documents read here are deleted, after they are in a bucket (or
+    found there already, on a re-run), so a send landing meanwhile is kept for
+    the next pass.
+    """
+    chat_id = chat["chat_id"]
+    moved = 0
+    while True:
+        batch = await db.messages.find(
+            {"chat_id": chat_id}, sort=sort_spec(MESSAGE_SORT_FIELDS), limit=MESSAGE_BUCKET_SIZE
+        )
+        for message in batch:
+            if not await find_message_key(db, chat, message["message_id"]):
+                await _append_to_bucket(db, chat, message)
+        if batch:
+            result = await db.messages.delete_many({"_id": {"$in": [message["_id"] for message in batch]}})
+            moved += result.deleted_count
+        if len(batch) < MESSAGE_BUCKET_SIZE:
+            return moved
+
+
+async def announce_bucketed(db):
+    """Record that chats may be bucketed; the first time, give servers a refresh to notice."""
+    result = await db.message_storage.update_one(
+        {"_id": STORAGE_STATE_ID}, {"$setOnInsert": {"since": datetime.now()}}, upsert=True
+    )
+    if result.upserted_id is not None:
+        await asyncio.sleep(2 * MESSAGE_STORAGE_REFRESH)
+
+
+class StorageWatch:
+    """Whether any chat may be bucketed; "documents" servers poll until one is, then stop."""
+
+    def __init__(self, db):
+        self.db = db
+        self.any_bucketed = MESSAGE_STORAGE == BUCKETED
+        self._task = None
+
+    async def start(self):
+        if self.any_bucketed:
+            # New chats here are bucketed: let "documents" servers know
+            self._task = asyncio.create_task(announce_bucketed(self.db))
+        else:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while not self.any_bucketed:
+            try:
+                self.any_bucketed = await self.db.message_storage.find_one({"_id": STORAGE_STATE_ID}) is not None
+            except Exception:
+                logger.exception("Message storage check error")
+            if not self.any_bucketed:
+                await asyncio.sleep(MESSAGE_STORAGE_REFRESH)
+
+
+async def _switch_chat(db, chat_id):
+    """Copy a chat's messages into full buckets and switch it over; returns (chat, moved).
+
+    The copied documents are deleted once the chat is bucketed. Sends that
+    had already read the chat as document-stored may still land in
+    `messages`; _settle picks those up.
+    """
+    chat = await db.chats.find_one({"chat_id": chat_id}, {"chat_id": 1, "storage": 1, "message_bucket": 1})
+    if not chat:
+        return None, 0
+    if is_bucketed(chat):
+        return chat, 0
+
+    seq = 0
+    last_key = None
+    copied = []
+    while True:
+        query = {"chat_id": chat_id}
+        if last_key is not None:
+            query.update(keyset_filter(MESSAGE_SORT_FIELDS, list(last_key)))
+        batch = await db.messages.find(query, sort=sort_spec(MESSAGE_SORT_FIELDS), limit=MESSAGE_BUCKET_SIZE)
+        if not batch:
+            break
+        await db.message_buckets.replace_one(
+            {"_id": bucket_id(chat_id, seq)},
+            {
+                "chat_id": chat_id,
+                "seq": seq,
+                "count": len(batch),
+                "first_timestamp": batch[0]["timestamp"],
+                "last_timestamp": batch[-1]["timestamp"],
+                "messages": [{field: m[field] for field in BUCKET_MESSAGE_FIELDS} for m in batch]
+            },
+            upsert=True
+        )
+        copied += [m["_id"] for m in batch]
+        last_key = _key(batch[-1])
+        if len(batch) < MESSAGE_BUCKET_SIZE:
+            break
+        seq += 1
+
+    # From here on new messages go to the buckets
+    await db.chats.update_one({"chat_id": chat_id}, {"$set": {"storage": BUCKETED, "message_bucket": seq}})
+    chat = {"chat_id": chat_id, "storage": BUCKETED, "message_bucket": seq}
+    moved = 0
+    for start in range(0, len(copied), MESSAGE_BUCKET_SIZE):
+        result = await db.messages.delete_many({"_id": {"$in": copied[start:start + MESSAGE_BUCKET_SIZE]}})
+        moved += result.deleted_count
+    return chat, moved
+
+
+async def _settle(db, chats):
+    """Catch up switched chats until a pass after the grace period finds nothing; returns how many moved."""
+    moved = 0
+    while True:
+        await asyncio.sleep(MESSAGE_MIGRATION_GRACE)
+        caught_up = 0
+        for chat in chats:
+            caught_up += await _catch_up(db, chat)
+        moved += caught_up
+        if not caught_up:
+            return moved
+
+
+async def convert_chat(db, chat_id):
+    """Move one chat's history from `messages` into buckets without losing concurrent sends.
+
+    Safe to re-run after an interruption, or to pick up a send later than
+    the grace period.
+    """
+    await announce_bucketed(db)
+    chat, moved = await _switch_chat(db, chat_id)
+    if not chat:
+        return 0
+    return moved + await _settle(db, [chat])
+
+
+async def convert_all(db, limit=0):
+    """Switch every document-stored chat over, then wait out one grace period for all of them."""
+    chats = await db.chats.find({"storage": {"$ne": BUCKETED}}, {"chat_id": 1}, limit=limit)
+    await announce_bucketed(db)
+    switched = []
+    moved = 0
+    for chat in chats:
+        chat, chat_moved = await _switch_chat(db, chat["chat_id"])
+        if chat:
+            switched.append(chat)
+            moved += chat_moved
+            print(f"📦 Converted chat {chat['chat_id']}")
+    moved += await _settle(db, switched)
+    return len(switched), moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert chats from per-message documents to bucketed storage")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--chat", help="convert a single chat_id")
+    target.add_argument("--all", action="store_true", help="convert every chat not yet bucketed")
+    parser.add_argument("--limit", type=int, default=0, help="with --all, stop after this many chats")
+    args = parser.parse_args()
+
+    import database
+
+    async def main():
+        if args.chat:
+            moved = await convert_chat(database.db, args.chat)
+            print(f"✅ Moved {moved} messages")
+        else:
+            chats, moved = await convert_all(database.db, args.limit)
+            print(f"✅ Converted {chats} chats, moved {moved} messages")
+        database.close()
+
+    asyncio.run(main())
@@ -0,0 +1,284 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+
+from log import get_logger
+
+logger = get_logger("metrics")
+
+# Requests slower than this (ms) are logged with the shapes of their queries; 0 disables
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+MAX_QUERY_SHAPES = int(os.environ.get('METRICS_MAX_QUERY_SHAPES', 20))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Bucket i counts values <= buckets[i]; the extra slot is +Inf
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Observed from the event loop and from driver threads, hence the lock.
+    Each worker process keeps its own numbers; scrape every worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+        self._gauges = {}
+
+    def _family(self, name, kind, help_text):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = {"kind": kind, "help": help_text, "series": {}}
+        return family
+
+    def observe(self, name, help_text, labels, value, buckets=LATENCY_BUCKETS):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._family(name, "histogram", help_text)["series"]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, help_text, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._family(name, "counter", help_text)["series"]
+            series[key] = series.get(key, 0) + amount
+
+    def register_gauge(self, name, help_text, fn, kind="gauge"):
+        """Sample fn() at scrape time; for values another component already keeps."""
+        self._gauges[name] = (kind, help_text, fn)
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, fn) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {fn()}"]
+        with self._lock:
+            for name, family in sorted(self._families.items()):
+                lines.append(f"# HELP {name} {family['help']}")
+                lines.append(f"# TYPE {name} {family['kind']}")
+                for key, value in sorted(family["series"].items()):
+                    if family["kind"] == "counter":
+                        lines.append(f"{name}{_labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(key + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(key)} {value.sum}")
+                    lines.append(f"{name}_count{_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in key) + "}"
+
+
+registry = Registry()
+
+
+class RequestStats:
+    """Database work attributed to one HTTP request; updated from driver threads."""
+
+    __slots__ = ("db_ops", "db_seconds", "documents", "shapes", "_lock")
+
+    def __init__(self):
+        self.db_ops = 0
+        self.db_seconds = 0.0
+        self.documents = 0
+        self.shapes = []
+        self._lock = threading.Lock()
+
+    def record(self, seconds, documents):
+        with self._lock:
+            self.db_ops += 1
+            self.db_seconds += seconds
+            self.documents += documents
+
+
+# Set per request by MetricsMiddleware; database.py copies the context into
+# its executor threads, where the command listener reads it
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def _shape(value, depth=0):
+    """Keep a query's field names and operators, replace literal values with "?"."""
+    if isinstance(value, dict):
+        if depth > 4:
+            return "…"
+        return {key: _shape(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return [_shape(item, depth + 1) for item in value]
+    return "?"
+
+
+def query_shape(command_name, command):
+    collection = command.get(command_name)
+    if command_name == "find":
+        parts = {"filter": command.get("filter"), "sort": command.get("sort")}
+    elif command_name == "aggregate":
+        parts = {"pipeline": [
+            {stage: _shape(spec) if stage in ("$match", "$sort", "$geoNear") else "…" for stage, spec in step.items()}
+            for step in command.get("pipeline", [])
+        ]}
+        return f"aggregate {collection} {json.dumps(parts, ensure_ascii=False)}"
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        parts = {"filter": statements[0].get("q"), "statements": len(statements)}
+    elif command_name == "findAndModify":
+        parts = {"filter": command.get("query")}
+    elif command_name == "count":
+        parts = {"filter": command.get("query")}
+    else:
+        parts = {}
+    shaped = {key: _shape(value) if key != "statements" else value for key, value in parts.items() if value}
+    return f"{command_name} {collection} {json.dumps(shaped, ensure_ascii=False)}".rstrip()
+
+
+def _documents_in(command_name, reply):
+    """Documents returned for reads, affected for writes."""
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    return reply.get("n", 0) if isinstance(reply.get("n"), int) else 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every driver command and attributes it to the request that issued it."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        # getMore names the cursor id first and the collection separately
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+        stats = current_request.get()
+        if SLOW_REQUEST_MS and stats is not None and len(stats.shapes) < MAX_QUERY_SHAPES:
+            stats.shapes.append(query_shape(event.command_name, event.command))
+
+    def _finish(self, event, documents, failed):
+        with self._lock:
+            collection = self._pending.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1e6
+        labels = {"command": event.command_name, "collection": collection}
+
+        registry.observe("gora_db_command_duration_seconds", "MongoDB command latency", labels, seconds)
+        if failed:
+            registry.inc("gora_db_command_failures_total", "Failed MongoDB commands", labels)
+        elif documents:
+            registry.inc("gora_db_documents_total", "Documents returned by reads and affected by writes", labels, documents)
+
+        stats = current_request.get()
+        if stats is not None:
+            stats.record(seconds, documents)
+
+    def succeeded(self, event):
+        self._finish(event, _documents_in(event.command_name, event.reply), False)
+
+    def failed(self, event):
+        self._finish(event, 0, True)
+
+
+command_listener = CommandMetrics()
+
+# HTTP requests currently being handled by this process; only touched on the event loop
+_in_flight = 0
+
+
+def in_flight_requests():
+    return _in_flight
+
+
+class MetricsMiddleware:
+    """Per-route latency and database usage for every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        root_path = scope.get("root_path", "")
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        _in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _in_flight -= 1
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+
+            # Label by route template, not the raw path, to keep cardinality bounded
+            route = getattr(scope.get("route"), "path", None)
+            if route is None:
+                mount = scope.get("root_path", "")
+                route = mount if mount != root_path else "unmatched"
+            labels = {"method": scope["method"], "route": route, "status": str(status)}
+            registry.observe("gora_http_request_duration_seconds", "HTTP request latency", labels, elapsed)
+            route_labels = {"method": scope["method"], "route": route}
+            registry.observe("gora_http_request_db_operations", "MongoDB commands per HTTP request", route_labels, stats.db_ops, COUNT_BUCKETS)
+            registry.observe("gora_http_request_db_seconds", "Time spent in MongoDB per HTTP request", route_labels, stats.db_seconds)
+
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                logger.warning(
+                    "Slow request",
+                    extra={
+                        "event": "slow_request",
+                        "method": scope["method"],
+                        "route": route,
+                        "status": status,
+                        "duration_ms": round(elapsed * 1000, 1),
+                        "db_ops": stats.db_ops,
+                        "db_ms": round(stats.db_seconds * 1000, 1),
+                        "documents": stats.documents,
+                        "query_shapes": stats.shapes
+                    }
+                )
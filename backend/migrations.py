@@ -0,0 +1,455 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from compaction import ARCHIVE_COLLECTION, dislike_index, dislike_ttl_seconds
+from feed import FEED_MAX_AGE
+from message_store import BUCKETED, STORAGE_STATE_ID
+
+# Collection that records which schema version this database is at
+MIGRATIONS_COLLECTION = "schema_migrations"
+MIGRATIONS_DOC_ID = "schema"
+# Only the process holding this lease migrates; it renews the lease every
+# third of MIGRATION_LEASE_SECONDS, and others wait until the schema is
+# current or the lease expires because its holder died
+MIGRATION_LEASE_ID = "lease"
+MIGRATION_LEASE_SECONDS = float(os.environ.get('MIGRATION_LEASE_SECONDS', 60))
+MIGRATION_LEASE_POLL = float(os.environ.get('MIGRATION_LEASE_POLL', 5))
+
+# Index builds on large collections take far longer than a regular query
+MIGRATION_TIMEOUT = float(os.environ.get('MIGRATION_TIMEOUT', 600))
+
+
+async def _create_indexes(db, collection_name, indexes):
+    """Create indexes and return the names that did not exist before."""
+    collection = db[collection_name]
+    existing = set(await collection.index_information(timeout=MIGRATION_TIMEOUT))
+    names = await collection.create_indexes(indexes, timeout=MIGRATION_TIMEOUT)
+    return [f"{collection_name}.{name}" for name in names if name not in existing]
+
+
+async def _drop_indexes(db, collection_name, names):
+    """Drop superseded indexes; already-missing ones are ignored."""
+    existing = set(await db[collection_name].index_information(timeout=MIGRATION_TIMEOUT))
+    for name in names:
+        if name in existing:
+            try:
+                await db[collection_name].drop_index(name, timeout=MIGRATION_TIMEOUT)
+            except OperationFailure:
+                pass
+
+
+async def _base_indexes(db):
+    created = []
+
+    # Identity lookups at the top of nearly every endpoint
+    created += await _create_indexes(db, "users", [
+        IndexModel([("telegram_id", ASCENDING)], unique=True, name="telegram_id_unique"),
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        # search_users: is_active + gender filter
+        IndexModel([("is_active", ASCENDING), ("gender", ASCENDING)], name="active_gender"),
+    ])
+
+    created += await _create_indexes(db, "interactions", [
+        # search_users exclusion list and handle_like reverse-like lookup
+        IndexModel([("user_id", ASCENDING), ("target_user_id", ASCENDING)], name="user_target"),
+        # get_received_likes
+        IndexModel([("target_user_id", ASCENDING), ("action", ASCENDING)], name="target_action"),
+    ])
+
+    created += await _create_indexes(db, "chats", [
+        IndexModel([("chat_id", ASCENDING)], unique=True, name="chat_id_unique"),
+        # get_user_chats: participants filter sorted by last_message_time
+        IndexModel([("participants", ASCENDING), ("last_message_time", DESCENDING)], name="participants_last_message"),
+    ])
+
+    created += await _create_indexes(db, "messages", [
+        IndexModel([("message_id", ASCENDING)], unique=True, name="message_id_unique"),
+        # get_chat_messages: chat_id filter sorted by timestamp
+        IndexModel([("chat_id", ASCENDING), ("timestamp", ASCENDING)], name="chat_timestamp"),
+    ])
+
+    return created
+
+
+async def _keyset_indexes(db):
+    created = []
+
+    # search_users keyset order (created_at, user_id) behind the same filter prefix
+    created += await _create_indexes(db, "users", [
+        IndexModel(
+            [("is_active", ASCENDING), ("gender", ASCENDING), ("created_at", ASCENDING), ("user_id", ASCENDING)],
+            name="active_gender_created_user"
+        ),
+    ])
+    await _drop_indexes(db, "users", ["active_gender"])
+
+    # get_chat_messages keyset order (timestamp, message_id) in both directions
+    created += await _create_indexes(db, "messages", [
+        IndexModel(
+            [("chat_id", ASCENDING), ("timestamp", ASCENDING), ("message_id", ASCENDING)],
+            name="chat_timestamp_message"
+        ),
+    ])
+    await _drop_indexes(db, "messages", ["chat_timestamp"])
+
+    return created
+
+
+async def _chat_list_indexes(db):
+    # get_user_chats keyset order (last_message_time, chat_id), newest first
+    created = await _create_indexes(db, "chats", [
+        IndexModel(
+            [("participants", ASCENDING), ("last_message_time", DESCENDING), ("chat_id", DESCENDING)],
+            name="participants_last_message_chat"
+        ),
+    ])
+    await _drop_indexes(db, "chats", ["participants_last_message"])
+    return created
+
+
+async def _received_likes_indexes(db):
+    # get_received_likes groups by liker; covering user_id and timestamp keeps it index-only
+    created = await _create_indexes(db, "interactions", [
+        IndexModel(
+            [("target_user_id", ASCENDING), ("action", ASCENDING), ("user_id", ASCENDING), ("timestamp", ASCENDING)],
+            name="target_action_user_timestamp"
+        ),
+    ])
+    await _drop_indexes(db, "interactions", ["target_action"])
+    return created
+
+
+async def _geo_indexes(db):
+    # search_users proximity mode: $geoNear over the GeoJSON point plus the search filter
+    return await _create_indexes(db, "users", [
+        IndexModel(
+            [("geo", GEOSPHERE), ("is_active", ASCENDING), ("gender", ASCENDING)],
+            name="geo_active_gender"
+        ),
+    ])
+
+
+async def _unique_swipes_and_chats(db):
+    created = []
+
+    # Collapse duplicate swipes on the same target to the most recent one
+    duplicates = await db.interactions.aggregate([
+        {"$sort": {"timestamp": -1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "target_user_id": "$target_user_id"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True, timeout=MIGRATION_TIMEOUT)
+    stale_ids = [stale_id for group in duplicates for stale_id in group["ids"][1:]]
+    if stale_ids:
+        await db.interactions.delete_many({"_id": {"$in": stale_ids}}, timeout=MIGRATION_TIMEOUT)
+
+    # Same key pattern as user_target, so it has to go before the unique one is built
+    await _drop_indexes(db, "interactions", ["user_target"])
+    created += await _create_indexes(db, "interactions", [
+        IndexModel([("user_id", ASCENDING), ("target_user_id", ASCENDING)], unique=True, name="user_target_unique"),
+    ])
+
+    # Backfill chat_key on existing match chats; the oldest chat of a pair keeps the key
+    chats = await db.chats.find(
+        {"chat_key": {"$exists": False}},
+        {"chat_id": 1, "participants": 1},
+        sort=[("created_at", ASCENDING)],
+        timeout=MIGRATION_TIMEOUT
+    )
+    taken = {chat["chat_key"] for chat in await db.chats.find(
+        {"chat_key": {"$exists": True}}, {"chat_key": 1}, timeout=MIGRATION_TIMEOUT
+    )}
+    updates = []
+    for chat in chats:
+        if len(chat.get("participants", [])) != 2:
+            continue
+        chat_key = ":".join(sorted(chat["participants"]))
+        if chat_key in taken:
+            continue
+        taken.add(chat_key)
+        updates.append(UpdateOne({"chat_id": chat["chat_id"]}, {"$set": {"chat_key": chat_key}}))
+    if updates:
+        await db.chats.bulk_write(updates, ordered=False, timeout=MIGRATION_TIMEOUT)
+
+    created += await _create_indexes(db, "chats", [
+        IndexModel(
+            [("chat_key", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"chat_key": {"$exists": True}},
+            name="chat_key_unique"
+        ),
+    ])
+    return created
+
+
+async def _unread_message_indexes(db):
+    # mark_chat_read flips is_read on a chat's unread tail; the partial index
+    # holds only unread messages, so it stays small however long chats get
+    return await _create_indexes(db, "messages", [
+        IndexModel(
+            [("chat_id", ASCENDING), ("timestamp", ASCENDING)],
+            partialFilterExpression={"is_read": False},
+            name="chat_unread_timestamp"
+        ),
+    ])
+
+
+async def _backfill_unread_counts(db):
+    # send_message now maintains chats.unread_counts. Nothing set is_read before
+    # mark-as-read existed, so all history still reads as unread: mark it read
+    # and start every counter at zero, keeping the two in agreement.
+    await db.messages.update_many({"is_read": False}, {"$set": {"is_read": True}}, timeout=MIGRATION_TIMEOUT)
+    await db.chats.update_many(
+        {"unread_counts": {"$exists": False}}, {"$set": {"unread_counts": {}}}, timeout=MIGRATION_TIMEOUT
+    )
+    return []
+
+
+async def _feed_queue_indexes(db):
+    # Whole queues expire FEED_MAX_AGE after they were first built and are rebuilt on demand
+    return await _create_indexes(db, "feed_queues", [
+        IndexModel([("built_at", ASCENDING)], expireAfterSeconds=FEED_MAX_AGE, name="built_at_ttl"),
+    ])
+
+
+async def _message_bucket_indexes(db):
+    # Paging walks a chat's buckets by their timestamp bounds in either
+    # direction; receipts for a given message look it up inside its bucket
+    return await _create_indexes(db, "message_buckets", [
+        IndexModel([("chat_id", ASCENDING), ("first_timestamp", ASCENDING)], name="chat_first_timestamp"),
+        IndexModel([("chat_id", ASCENDING), ("last_timestamp", ASCENDING)], name="chat_last_timestamp"),
+        IndexModel([("chat_id", ASCENDING), ("messages.message_id", ASCENDING)], name="chat_message_id"),
+    ])
+
+
+async def _interaction_archive_indexes(db):
+    created = await _create_indexes(db, ARCHIVE_COLLECTION, [
+        # Multikey: which of a batch of candidates a user has archived dislikes for
+        IndexModel([("user_id", ASCENDING), ("targets", ASCENDING)], name="user_targets"),
+    ])
+    # The compaction job's scan over old dislikes. Partial, so it holds only
+    # dislikes; with DISLIKE_TTL_DAYS set it also expires them as a backstop
+    # (later changes are applied by reconcile_dislike_ttl on startup).
+    created += await _create_indexes(db, "interactions", [dislike_index(dislike_ttl_seconds())])
+    return created
+
+
+async def _pending_likes(db):
+    # get_received_likes counts pending_likes for its badge; apply_swipes keeps
+    # it in step from now on, seeded here from likes not yet answered
+    created = await _create_indexes(db, "pending_likes", [
+        IndexModel([("target_user_id", ASCENDING)], name="target_user"),
+    ])
+    answered_lookup = {
+        "from": "interactions",
+        "let": {"liker_id": "$user_id", "liked_id": "$target_user_id"},
+        "pipeline": [
+            {"$match": {"$expr": {"$and": [
+                {"$eq": ["$user_id", "$$liked_id"]},
+                {"$eq": ["$target_user_id", "$$liker_id"]}
+            ]}}},
+            {"$limit": 1},
+            {"$project": {"_id": 1}}
+        ],
+        "as": "answered"
+    }
+    archived_lookup = {
+        "from": ARCHIVE_COLLECTION,
+        "let": {"liker_id": "$user_id", "liked_id": "$target_user_id"},
+        "pipeline": [
+            {"$match": {"$expr": {"$and": [
+                {"$eq": ["$user_id", "$$liked_id"]},
+                {"$in": ["$$liker_id", "$targets"]}
+            ]}}},
+            {"$limit": 1},
+            {"$project": {"_id": 1}}
+        ],
+        "as": "archived"
+    }
+    pending = await db.interactions.aggregate([
+        {"$match": {"action": {"$in": ["like", "super_like"]}}},
+        {"$lookup": answered_lookup},
+        {"$match": {"answered": {"$size": 0}}},
+        {"$lookup": archived_lookup},
+        {"$match": {"archived": {"$size": 0}}},
+        {"$project": {"_id": 0, "user_id": 1, "target_user_id": 1, "action": 1, "timestamp": 1}}
+    ], allowDiskUse=True, timeout=MIGRATION_TIMEOUT)
+
+    updates = [
+        UpdateOne(
+            {"_id": f"{like['target_user_id']}:{like['user_id']}"},
+            {"$set": {
+                "target_user_id": like["target_user_id"],
+                "user_id": like["user_id"],
+                "is_super_like": like["action"] == "super_like",
+                "liked_at": like["timestamp"]
+            }},
+            upsert=True
+        )
+        for like in pending
+    ]
+    for start in range(0, len(updates), 1000):
+        await db.pending_likes.bulk_write(updates[start:start + 1000], ordered=False, timeout=MIGRATION_TIMEOUT)
+    return created
+
+
+async def _pending_likes_listing(db):
+    # get_received_likes pages pending_likes directly, super likes first, then
+    # most recent; entries seeded by an earlier version 12 lack the sort fields
+    created = await _create_indexes(db, "pending_likes", [
+        IndexModel(
+            [("target_user_id", ASCENDING), ("is_super_like", DESCENDING), ("liked_at", DESCENDING), ("user_id", DESCENDING)],
+            name="target_super_liked_user"
+        ),
+    ])
+    # The count-only badge is served by the new index's prefix
+    await _drop_indexes(db, "pending_likes", ["target_user"])
+
+    missing = await db.pending_likes.find(
+        {"liked_at": {"$exists": False}}, {"_id": 0, "user_id": 1, "target_user_id": 1}, timeout=MIGRATION_TIMEOUT
+    )
+    for start in range(0, len(missing), 1000):
+        chunk = missing[start:start + 1000]
+        likes = await db.interactions.find(
+            {"$or": [{"user_id": like["user_id"], "target_user_id": like["target_user_id"]} for like in chunk]},
+            {"_id": 0, "user_id": 1, "target_user_id": 1, "action": 1, "timestamp": 1},
+            timeout=MIGRATION_TIMEOUT
+        )
+        updates = [
+            UpdateOne(
+                {"_id": f"{like['target_user_id']}:{like['user_id']}"},
+                {"$set": {"is_super_like": like["action"] == "super_like", "liked_at": like["timestamp"]}}
+            )
+            for like in likes
+        ]
+        if updates:
+            await db.pending_likes.bulk_write(updates, ordered=False, timeout=MIGRATION_TIMEOUT)
+    return created
+
+
+async def _message_storage_state(db):
+    # "documents" servers only look up a chat's storage mode once this state
+    # exists; chats converted before it was introduced still need it
+    if await db.chats.find_one({"storage": BUCKETED}, {"_id": 1}, timeout=MIGRATION_TIMEOUT):
+        await db.message_storage.update_one(
+            {"_id": STORAGE_STATE_ID}, {"$setOnInsert": {"since": datetime.now()}}, upsert=True
+        )
+    return []
+
+
+async def _archive_bucket_counts(db):
+    # Buckets filled before _archive sized its writes can hold more than
+    # ARCHIVE_BUCKET_SIZE targets, or count duplicates $addToSet dropped
+    await db[ARCHIVE_COLLECTION].update_many(
+        {}, [{"$set": {"count": {"$size": "$targets"}}}], timeout=MIGRATION_TIMEOUT
+    )
+    return []
+
+
+# Ordered (version, description, step) list. Steps must be idempotent: a
+# step may be re-run if the process dies before its version is recorded.
+MIGRATIONS = [
+    (1, "base indexes for users, interactions, chats and messages", _base_indexes),
+    (2, "keyset pagination indexes for search and message history", _keyset_indexes),
+    (3, "keyset pagination index for the chat list", _chat_list_indexes),
+    (4, "covering index for received likes", _received_likes_indexes),
+    (5, "2dsphere index for proximity search", _geo_indexes),
+    (6, "unique swipe per user pair and one chat per match", _unique_swipes_and_chats),
+    (7, "partial index over unread messages for mark-as-read", _unread_message_indexes),
+    (8, "mark existing messages read and start unread counters at zero", _backfill_unread_counts),
+    (9, "expire precomputed feed queues", _feed_queue_indexes),
+    (10, "indexes for bucketed message storage", _message_bucket_indexes),
+    (11, "archive for compacted dislikes", _interaction_archive_indexes),
+    (12, "pending likes behind the received-likes badge", _pending_likes),
+    (13, "serve the received-likes list from pending likes", _pending_likes_listing),
+    (14, "record whether any chat stores bucketed messages", _message_storage_state),
+    (15, "recount archived dislike targets per bucket", _archive_bucket_counts),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def schema_version(db):
+    """The version this database's schema has been migrated to; 0 if never migrated."""
+    state = await db[MIGRATIONS_COLLECTION].find_one({"_id": MIGRATIONS_DOC_ID})
+    return state["version"] if state else 0
+
+
+async def _take_lease(db, owner):
+    """Take or renew the migration lease; False while another live process holds it."""
+    now = datetime.now()
+    try:
+        await db[MIGRATIONS_COLLECTION].find_one_and_update(
+            {"_id": MIGRATION_LEASE_ID, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=MIGRATION_LEASE_SECONDS)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lease exists and matched neither condition
+        return False
+    return True
+
+
+async def _renew_lease(db, owner, lost):
+    while True:
+        await asyncio.sleep(MIGRATION_LEASE_SECONDS / 3)
+        try:
+            if not await _take_lease(db, owner):
+                lost.set()
+                return
+        except Exception:
+            # Retried next round; the lease outlives two missed renewals
+            pass
+
+
+async def run_migrations(db):
+    """Apply every migration newer than the recorded schema version and report what changed.
+
+    Concurrent callers wait for whichever holds the lease, then find nothing left to do.
+    """
+    owner = uuid.uuid4().hex
+    while not await _take_lease(db, owner):
+        current_version = await schema_version(db)
+        if current_version >= SCHEMA_VERSION:
+            return {"from_version": current_version, "to_version": current_version, "applied": [], "created": []}
+        await asyncio.sleep(MIGRATION_LEASE_POLL)
+    return await _migrate(db, owner)
+
+
+async def _migrate(db, owner):
+    lost = asyncio.Event()
+    renewal = asyncio.create_task(_renew_lease(db, owner, lost))
+    try:
+        # Read under the lease: a previous holder may have finished meanwhile
+        current_version = await schema_version(db)
+
+        report = {"from_version": current_version, "to_version": current_version, "applied": [], "created": []}
+        for version, description, step in MIGRATIONS:
+            if version <= current_version:
+                continue
+            if lost.is_set():
+                raise RuntimeError(f"Migration lease lost before version {version}")
+
+            created = await step(db) or []
+            # $max: a version recorded by a newer deploy is never moved back
+            await db[MIGRATIONS_COLLECTION].update_one(
+                {"_id": MIGRATIONS_DOC_ID},
+                {"$max": {"version": version}, "$set": {"applied_at": datetime.now()}},
+                upsert=True
+            )
+            report["to_version"] = version
+            report["applied"].append({"version": version, "description": description})
+            report["created"].extend(created)
+
+        return report
+    finally:
+        renewal.cancel()
+        await db[MIGRATIONS_COLLECTION].delete_many({"_id": MIGRATION_LEASE_ID, "owner": owner})
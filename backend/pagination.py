@@ -0,0 +1,63 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException
+
+# Opaque keyset cursors: the sort-key values of the last item on a page plus
+# the direction to continue in, serialized as urlsafe base64 JSON.
+FORWARD = "after"
+BACKWARD = "before"
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "$dt" in value:
+        return datetime.fromisoformat(value["$dt"])
+    return value
+
+
+def encode_cursor(values, direction=FORWARD):
+    payload = {"k": [_encode_value(v) for v in values], "d": direction}
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, key_count):
+    """Return (values, direction) or raise a 400 for anything that is not one of our cursors."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        values = [_decode_value(v) for v in payload["k"]]
+        direction = payload["d"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if len(values) != key_count or direction not in (FORWARD, BACKWARD):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values, direction
+
+
+def keyset_filter(fields, values, direction=FORWARD):
+    """Match documents strictly after (or before) values in the (fields...) sort order.
+
+    Every field is sorted in the same direction; the last field must be unique
+    so that ties on the leading fields are broken deterministically.
+    """
+    op = "$gt" if direction == FORWARD else "$lt"
+    clauses = []
+    for i, field in enumerate(fields):
+        clause = {f: values[j] for j, f in enumerate(fields[:i])}
+        clause[field] = {op: values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+def sort_spec(fields, direction=FORWARD):
+    order = 1 if direction == FORWARD else -1
+    return [(field, order) for field in fields]
@@ -0,0 +1,183 @@
+import mimetypes
+import os
+import stat
+from collections import OrderedDict
+from email.utils import formatdate
+
+import anyio
+
+from photos import CONTENT_NAME_RE
+
+CHUNK_SIZE = 64 * 1024
+STAT_CACHE_SIZE = int(os.environ.get('PHOTO_STAT_CACHE_SIZE', 10000))
+# Legacy (non content-addressed) uploads may be replaced in place
+LEGACY_MAX_AGE = int(os.environ.get('PHOTO_LEGACY_MAX_AGE', 86400))
+# When set (e.g. /protected-uploads), nginx serves the bytes via X-Accel-Redirect
+PHOTO_ACCEL_PREFIX = os.environ.get('PHOTO_ACCEL_PREFIX', '')
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class _FileInfo:
+    __slots__ = ("path", "size", "etag", "last_modified", "content_type", "immutable")
+
+    def __init__(self, path, stat_result, immutable):
+        self.path = path
+        self.size = stat_result.st_size
+        self.immutable = immutable
+        name = os.path.basename(path)
+        if immutable:
+            # The name is the content hash, which makes a strong validator
+            self.etag = f'"{name.split("_")[0]}"'
+        else:
+            self.etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+        self.last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+def _parse_range(header, size):
+    """Parse a single-range "bytes=" header into (start, end) inclusive; None if unusable, False if unsatisfiable."""
+    units, _, spec = header.partition("=")
+    if units.strip() != "bytes" or "," in spec:
+        return None
+    start_s, _, end_s = spec.strip().partition("-")
+    try:
+        if start_s == "":
+            length = int(end_s)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class PhotoFiles:
+    """ASGI app serving /uploads with long-lived caching, conditional and range requests.
+
+    Bodies go out through the server's zero-copy sendfile extension when it
+    offers one, through nginx when PHOTO_ACCEL_PREFIX is set, and otherwise in
+    chunks read off the event loop.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.realpath(directory)
+        self._stat_cache = OrderedDict()
+
+    async def _lookup(self, name):
+        info = self._stat_cache.get(name)
+        if info is not None:
+            self._stat_cache.move_to_end(name)
+            return info
+
+        path = os.path.join(self.directory, name)
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            return None
+
+        immutable = bool(CONTENT_NAME_RE.match(name))
+        info = _FileInfo(path, stat_result, immutable)
+        # Legacy files can change under the same name, so only cache hashed ones
+        if immutable:
+            self._stat_cache[name] = info
+            if len(self._stat_cache) > STAT_CACHE_SIZE:
+                self._stat_cache.popitem(last=False)
+        return info
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        method = scope["method"]
+        if method not in ("GET", "HEAD"):
+            await self._send_empty(send, 405, [(b"allow", b"GET, HEAD")])
+            return
+
+        name = scope["path"].lstrip("/")
+        if not name or "/" in name or "\\" in name or name.startswith("."):
+            await self._send_empty(send, 404)
+            return
+
+        info = await self._lookup(name)
+        if info is None:
+            await self._send_empty(send, 404)
+            return
+
+        request_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        headers = [
+            (b"etag", info.etag.encode()),
+            (b"last-modified", info.last_modified.encode()),
+            (b"cache-control", (IMMUTABLE_CACHE_CONTROL if info.immutable else f"public, max-age={LEGACY_MAX_AGE}").encode()),
+            (b"accept-ranges", b"bytes"),
+        ]
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or info.etag in [t.strip() for t in if_none_match.split(",")]):
+            await self._send_empty(send, 304, headers)
+            return
+
+        if PHOTO_ACCEL_PREFIX and method == "GET":
+            # nginx streams the file with sendfile and applies any Range itself
+            headers += [
+                (b"content-type", info.content_type.encode()),
+                (b"x-accel-redirect", f"{PHOTO_ACCEL_PREFIX.rstrip('/')}/{name}".encode()),
+            ]
+            await self._send_empty(send, 200, headers)
+            return
+
+        status = 200
+        start, end = 0, info.size - 1
+        range_header = request_headers.get("range")
+        if range_header and info.size and request_headers.get("if-range", info.etag) == info.etag:
+            parsed = _parse_range(range_header, info.size)
+            if parsed is False:
+                headers.append((b"content-range", f"bytes */{info.size}".encode()))
+                await self._send_empty(send, 416, headers)
+                return
+            if parsed:
+                status = 206
+                start, end = parsed
+                headers.append((b"content-range", f"bytes {start}-{end}/{info.size}".encode()))
+
+        length = max(end - start + 1, 0)
+        headers += [
+            (b"content-type", info.content_type.encode()),
+            (b"content-length", str(length).encode()),
+        ]
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if method == "HEAD" or length == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(info.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file.fileno(),
+                    "offset": start,
+                    "count": length,
+                })
+            return
+
+        async with await anyio.open_file(info.path, "rb") as file:
+            await file.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = await file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})
+
+    async def _send_empty(self, send, status, headers=None):
+        await send({"type": "http.response.start", "status": status, "headers": headers or []})
+        await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Longest-edge size in pixels for each stored variant
+PHOTO_VARIANTS = {"thumb": 160, "card": 640, "full": 1440}
+PHOTO_FORMAT = "WEBP"
+PHOTO_EXTENSION = "webp"
+PHOTO_QUALITY = int(os.environ.get('PHOTO_QUALITY', 80))
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', os.cpu_count() or 1))
+PHOTO_MAX_BYTES = int(os.environ.get('PHOTO_MAX_BYTES', 15 * 1024 * 1024))
+
+# Images over this many pixels are refused before decoding (see _encode_variants)
+Image.MAX_IMAGE_PIXELS = int(os.environ.get('PHOTO_MAX_PIXELS', 40_000_000))
+
+
+class PhotoError(ValueError):
+    pass
+
+
+def _encode_variants(data):
+    """Decode, normalize orientation, drop metadata and encode every variant. Runs in a worker process."""
+    try:
+        with warnings.catch_warnings():
+            # PIL only raises above twice MAX_IMAGE_PIXELS and merely warns
+            # between the two; refuse those too instead of decoding them
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            with Image.open(BytesIO(data)) as image:
+                image = ImageOps.exif_transpose(image)
+                has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+                image = image.convert("RGBA" if has_alpha else "RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, Image.DecompressionBombWarning, OSError):
+        raise PhotoError("Unsupported or corrupt image")
+
+    variants = {}
+    for name, size in PHOTO_VARIANTS.items():
+        variant = image.copy()
+        variant.thumbnail((size, size), Image.LANCZOS)
+        buffer = BytesIO()
+        # Re-encoding from pixels leaves EXIF/GPS and other metadata behind
+        variant.save(buffer, PHOTO_FORMAT, quality=PHOTO_QUALITY, method=4)
+        variants[name] = buffer.getvalue()
+    return variants
+
+
+def _write_file(path, data):
+    # Write then rename so a half-written file is never served
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp")
+    with open(tmp_path, "wb") as buffer:
+        buffer.write(data)
+    os.replace(tmp_path, path)
+
+
+# Content-addressed names: a hash of the upload plus every encoding setting,
+# so a given name always maps to the same bytes and can be cached forever
+CONTENT_NAME_RE = re.compile(r"^[0-9a-f]{32}_[a-z]+\.[a-z0-9]+$")
+
+
+def content_filenames(data):
+    settings = f"{PHOTO_FORMAT}:{PHOTO_QUALITY}:{sorted(PHOTO_VARIANTS.items())}".encode()
+    digest = hashlib.sha256(settings + b"\0" + data).hexdigest()[:32]
+    return {name: f"{digest}_{name}.{PHOTO_EXTENSION}" for name in PHOTO_VARIANTS}
+
+
+def process_photo(data, uploads_dir):
+    """Encode all variants of one upload and store them; returns variant -> filename."""
+    filenames = content_filenames(data)
+    paths = {name: Path(uploads_dir) / filename for name, filename in filenames.items()}
+
+    # Re-upload of an identical photo: reuse the stored variants
+    if all(path.exists() for path in paths.values()):
+        return filenames
+
+    for name, encoded in _encode_variants(data).items():
+        _write_file(paths[name], encoded)
+    return filenames
+
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn: the parent runs driver threads, which do not survive fork safely
+        _pool = ProcessPoolExecutor(max_workers=PHOTO_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def save_photo(upload, uploads_dir):
+    """Process an UploadFile off the event loop; returns variant -> URL."""
+    data = await upload.read(PHOTO_MAX_BYTES + 1)
+    if len(data) > PHOTO_MAX_BYTES:
+        raise PhotoError("Photo is too large")
+
+    loop = asyncio.get_running_loop()
+    filenames = await loop.run_in_executor(_get_pool(), process_photo, data, str(uploads_dir))
+    return {name: f"/uploads/{filename}" for name, filename in filenames.items()}
+
+
+def shutdown():
+    if _pool is not None:
+        _pool.shutdown(wait=True)
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+# Spoky tiles are small ints; each user's selection becomes one 64-bit word
+SPOKY_BITS = 64
+
+RANK_METRIC = os.environ.get('RANK_METRIC', 'jaccard')  # "jaccard" or "overlap"
+RANK_WEIGHT_SPOKIES = float(os.environ.get('RANK_WEIGHT_SPOKIES', 1.0))
+RANK_WEIGHT_AGE = float(os.environ.get('RANK_WEIGHT_AGE', 0.3))
+RANK_WEIGHT_RELATIONSHIP = float(os.environ.get('RANK_WEIGHT_RELATIONSHIP', 0.2))
+# Age gap (in years) at which the age score has dropped to 1/e
+RANK_AGE_SCALE = float(os.environ.get('RANK_AGE_SCALE', 5))
+# Age score given to candidates whose age is unknown, halfway along the 0..1 scale
+RANK_UNKNOWN_AGE_SCORE = float(os.environ.get('RANK_UNKNOWN_AGE_SCORE', 0.5))
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """Set-bit count of each uint64 in words."""
+    return _POPCOUNT8[words.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def encode_bitsets(lists, bit_of=None, width=SPOKY_BITS):
+    """Encode a list of int lists as uint64 words; values outside [0, width) are ignored."""
+    lengths = np.fromiter((len(values) for values in lists), dtype=np.int64, count=len(lists))
+    flat = np.fromiter(
+        (v if bit_of is None else bit_of(v) for values in lists for v in values),
+        dtype=np.int64,
+        count=int(lengths.sum())
+    )
+    owners = np.repeat(np.arange(len(lists)), lengths)
+    valid = (flat >= 0) & (flat < width)
+
+    words = np.zeros(len(lists), dtype=np.uint64)
+    np.bitwise_or.at(words, owners[valid], np.left_shift(np.uint64(1), flat[valid].astype(np.uint64)))
+    return words
+
+
+def score_candidates(requester, candidates, metric=RANK_METRIC):
+    """Score a whole candidate batch against the requester in one pass."""
+    # Interest similarity
+    requester_bits = encode_bitsets([requester.get("selected_spokies") or []])[0]
+    candidate_bits = encode_bitsets([c.get("selected_spokies") or [] for c in candidates])
+    shared = popcount(candidate_bits & requester_bits).astype(np.float64)
+    if metric == "overlap":
+        smaller = np.minimum(popcount(candidate_bits), popcount(np.array([requester_bits])))
+        similarity = np.divide(shared, smaller, out=np.zeros_like(shared), where=smaller > 0)
+    else:
+        union = popcount(candidate_bits | requester_bits).astype(np.float64)
+        similarity = np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+    scores = RANK_WEIGHT_SPOKIES * similarity
+
+    # Age proximity. Left out when the requester's age is unknown; an unknown
+    # candidate age scores the midpoint, so it neither helps nor buries them.
+    # A fixed value rather than the batch mean keeps match_score independent of the batch.
+    requester_age = requester.get("age")
+    if RANK_WEIGHT_AGE and requester_age is not None:
+        ages = np.array([c.get("age") if c.get("age") is not None else np.nan for c in candidates], dtype=np.float64)
+        age_score = np.exp(-np.square((ages - requester_age) / RANK_AGE_SCALE))
+        scores += RANK_WEIGHT_AGE * np.nan_to_num(age_score, nan=RANK_UNKNOWN_AGE_SCORE)
+
+    # Shared relationship goals, encoded against the requester's own vocabulary
+    requester_types = list(dict.fromkeys(requester.get("relationship_type") or []))[:SPOKY_BITS]
+    if RANK_WEIGHT_RELATIONSHIP and requester_types:
+        vocabulary = {t: i for i, t in enumerate(requester_types)}
+        candidate_types = encode_bitsets(
+            [c.get("relationship_type") or [] for c in candidates],
+            bit_of=lambda t: vocabulary.get(t, -1)
+        )
+        scores += RANK_WEIGHT_RELATIONSHIP * (candidate_types != 0)
+
+    return scores
+
+
+def rank_candidates(requester, candidates, k):
+    """Return the top-k candidates by score, best first, each tagged with match_score."""
+    if not candidates:
+        return []
+
+    scores = score_candidates(requester, candidates)
+    k = min(k, len(candidates))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+
+    ranked = []
+    for i in top:
+        candidate = candidates[i]
+        candidate["match_score"] = round(float(scores[i]), 4)
+        ranked.append(candidate)
+    return ranked
@@ -0,0 +1,94 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from metrics import registry
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+# "memory" limits per worker process; "broker" shares buckets through the
+# realtime broker process (BROKER_URL) and falls back to memory if it is unreachable
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+# How long a request may wait on the shared backend before deciding locally
+RATE_LIMIT_SHARED_TIMEOUT = float(os.environ.get('RATE_LIMIT_SHARED_TIMEOUT', 0.05))
+
+
+def parse_limit(text):
+    """"burst/seconds": a bucket of burst tokens that refills completely over seconds."""
+    burst, _, seconds = text.partition("/")
+    return float(burst), float(burst) / float(seconds or 1)
+
+
+# Budget per telegram_id and route, as (capacity, tokens per second)
+RATE_LIMITS = {
+    "like": parse_limit(os.environ.get('RATE_LIMIT_LIKE', '120/60')),
+    "message": parse_limit(os.environ.get('RATE_LIMIT_MESSAGE', '60/60')),
+}
+
+
+class TokenBuckets:
+    """Token buckets keyed by string, refilled lazily on each take.
+
+    Least recently used keys are evicted past max_keys; an evicted key simply
+    starts again with a full bucket.
+    """
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def take(self, key, cost, capacity, rate):
+        """Spend cost tokens if available; returns (allowed, seconds until it would be)."""
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, shared=None):
+        self.limits = limits
+        self.local = TokenBuckets()
+        # Anything with an async request(payload, timeout) returning a dict or None
+        self.shared = shared
+
+    async def check(self, route, user_key, cost=1):
+        """Raise 429 with Retry-After when user_key has spent its budget for route."""
+        limit = self.limits.get(route)
+        if not RATE_LIMIT_ENABLED or not limit:
+            return
+        capacity, rate = limit
+        # A single request larger than the whole bucket may spend all of it
+        cost = min(cost, capacity)
+        key = f"{route}:{user_key}"
+
+        reply = None
+        if self.shared is not None:
+            reply = await self.shared.request(
+                {"op": "take", "key": key, "cost": cost, "capacity": capacity, "rate": rate},
+                RATE_LIMIT_SHARED_TIMEOUT
+            )
+        if reply is not None:
+            allowed, retry_after = reply["allowed"], reply["retry_after"]
+        else:
+            allowed, retry_after = self.local.take(key, cost, capacity, rate)
+
+        if not allowed:
+            registry.inc("gora_rate_limited_total", "Requests rejected by the rate limiter", {"route": route})
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(math.ceil(retry_after), 1))}
+            )
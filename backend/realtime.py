@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import urlparse
+
+from log import get_logger
+from ratelimit import TokenBuckets
+
+logger = get_logger("realtime")
+
+# Empty BROKER_URL keeps fan-out inside this process. With several workers,
+# run `python realtime.py` once and point every worker at it, e.g.
+# BROKER_URL=tcp://127.0.0.1:8765
+BROKER_URL = os.environ.get('BROKER_URL', '')
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('SUBSCRIBER_QUEUE_SIZE', 100))
+BROKER_RECONNECT_DELAY = float(os.environ.get('BROKER_RECONNECT_DELAY', 1))
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(payload):
+    return json.dumps(payload, default=_json_default, separators=(",", ":"))
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+class InProcessBroker:
+    """Fans events out to subscriber queues in this process."""
+
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self.dropped = 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def subscribe(self, channel):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[channel].add(queue)
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        queues = self._subscribers.get(channel)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[channel]
+
+    def _deliver(self, channel, event):
+        for queue in self._subscribers.get(channel, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # A stalled client must not hold up everyone else
+                self.dropped += 1
+
+    async def publish(self, channel, event):
+        self._deliver(channel, event)
+
+    async def request(self, payload, timeout):
+        # No shared process to ask; callers fall back to local state
+        return None
+
+    def stats(self):
+        return {
+            "channels": len(self._subscribers),
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "dropped": self.dropped
+        }
+
+
+class TcpBroker(InProcessBroker):
+    """Relays events through a shared broker process so they reach subscribers on every worker.
+
+    Local queues work as in InProcessBroker; the connection only tells the
+    broker which channels this worker cares about and carries publishes both ways.
+    """
+
+    def __init__(self, url, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        super().__init__(queue_size)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 8765
+        self._writer = None
+        self._connected = None
+        self._task = None
+        self._replies = {}
+        self._next_request_id = 0
+
+    async def start(self):
+        # Created here so it binds to the server's event loop
+        self._connected = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+
+    def _is_connected(self):
+        return self._connected is not None and self._connected.is_set()
+
+    async def _send(self, payload):
+        """Best effort: False if the broker is down or the write fails, which never raises."""
+        if not self._is_connected():
+            # Never make a request wait on the broker; clients resync over HTTP
+            self.dropped += 1
+            return False
+        try:
+            self._writer.write((dumps(payload) + "\n").encode())
+            await self._writer.drain()
+        except OSError as error:
+            # Dropped mid-write: count as disconnected now; closing the writer
+            # ends the read loop, which reconnects
+            logger.warning("Broker write error: %s", error)
+            self._connected.clear()
+            self._writer.close()
+            self.dropped += 1
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                self._connected.set()
+                # Re-announce every channel after a (re)connect
+                for channel in list(self._subscribers):
+                    self._writer.write((dumps({"op": "sub", "channel": channel}) + "\n").encode())
+                await self._writer.drain()
+
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                    if "id" in message:
+                        reply = self._replies.pop(message["id"], None)
+                        if reply is not None and not reply.done():
+                            reply.set_result(message)
+                    else:
+                        self._deliver(message["channel"], message["event"])
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ValueError) as error:
+                logger.warning("Broker connection error: %s", error)
+            finally:
+                self._connected.clear()
+                # Outstanding requests get no answer; their callers decide locally
+                for reply in self._replies.values():
+                    if not reply.done():
+                        reply.set_result(None)
+                self._replies.clear()
+
+            await asyncio.sleep(BROKER_RECONNECT_DELAY)
+
+    def subscribe(self, channel):
+        first = channel not in self._subscribers
+        queue = super().subscribe(channel)
+        if first and self._is_connected():
+            asyncio.create_task(self._send({"op": "sub", "channel": channel}))
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        super().unsubscribe(channel, queue)
+        if channel not in self._subscribers and self._is_connected():
+            asyncio.create_task(self._send({"op": "unsub", "channel": channel}))
+
+    async def publish(self, channel, event):
+        if not self._is_connected():
+            # Broker down: other workers miss this event, but this one's own subscribers still get it
+            self._deliver(channel, event)
+            return
+        # The broker echoes the event back to this worker if it has subscribers
+        if not await self._send({"op": "pub", "channel": channel, "event": event}):
+            self._deliver(channel, event)
+
+    async def request(self, payload, timeout):
+        """Ask the broker process and wait briefly for its answer; None if unavailable or too slow."""
+        if not self._is_connected():
+            return None
+        self._next_request_id += 1
+        request_id = self._next_request_id
+        reply = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = reply
+        try:
+            if not await self._send({**payload, "id": request_id}):
+                return None
+            return await asyncio.wait_for(reply, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._replies.pop(request_id, None)
+
+
+def create_broker(url=BROKER_URL):
+    if url:
+        return TcpBroker(url)
+    return InProcessBroker()
+
+
+broker = create_broker()
+
+
+async def publish_to_users(user_ids, event):
+    for user_id in user_ids:
+        await broker.publish(user_channel(user_id), event)
+
+
+async def run_broker_server(host, port):
+    """Standalone broker process: forwards each publish to the workers subscribed to its channel.
+
+    Also answers "take" requests from every worker's rate limiter against one shared set of buckets.
+    """
+    subscriptions = defaultdict(set)
+    buckets = TokenBuckets()
+
+    async def handle(reader, writer):
+        channels = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                channel = message.get("channel")
+                if op == "sub":
+                    channels.add(channel)
+                    subscriptions[channel].add(writer)
+                elif op == "unsub":
+                    channels.discard(channel)
+                    subscriptions[channel].discard(writer)
+                    if not subscriptions[channel]:
+                        del subscriptions[channel]
+                elif op == "pub":
+                    data = (dumps({"channel": channel, "event": message["event"]}) + "\n").encode()
+                    for subscriber in list(subscriptions.get(channel, ())):
+                        subscriber.write(data)
+                elif op == "take":
+                    allowed, retry_after = buckets.take(message["key"], message["cost"], message["capacity"], message["rate"])
+                    writer.write((dumps({"id": message["id"], "allowed": allowed, "retry_after": retry_after}) + "\n").encode())
+        except (OSError, ValueError):
+            pass
+        finally:
+            for channel in channels:
+                subscriptions[channel].discard(writer)
+                if not subscriptions[channel]:
+                    del subscriptions[channel]
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"📡 Broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local pub/sub broker for multi-worker chat delivery")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    asyncio.run(run_broker_server(args.host, args.port))
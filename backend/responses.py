@@ -0,0 +1,32 @@
+import orjson
+from bson import ObjectId
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON rendered by orjson, which handles datetimes natively and ObjectIds via _default.
+
+    Endpoints that return an instance directly also skip FastAPI's
+    jsonable_encoder pass over the payload.
+    """
+
+    def render(self, content):
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def parse_fields(fields, allowed):
+    """Turn a comma-separated fields= parameter into a list of names; None means all fields."""
+    if fields is None:
+        return None
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in allowed]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields requested")
+    return names
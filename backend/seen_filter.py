@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import os
+
+from bson.int64 import Int64
+
+from compaction import all_archived_targets, archived_targets
+
+# Per-user Bloom filter over the target_user_ids a user has swiped on.
+# Stored as an array of 64-bit words so handle_like can set bits with an
+# atomic $bit update instead of a read-modify-write.
+SEEN_FILTERS_COLLECTION = "seen_filters"
+# Smallest filter; each user's is sized from their swipe count, doubling
+# from here, and rebuilt larger once it holds more than it was sized for
+SEEN_FILTER_BITS = int(os.environ.get('SEEN_FILTER_BITS', 65536))
+SEEN_FILTER_HASHES = int(os.environ.get('SEEN_FILTER_HASHES', 5))
+# 10 bits per entry with 5 hashes keeps false positives around 1%
+SEEN_FILTER_BITS_PER_ITEM = int(os.environ.get('SEEN_FILTER_BITS_PER_ITEM', 10))
+# 2^25 bits is 512k words, about 8MB stored, well under the document limit
+SEEN_FILTER_MAX_BITS = int(os.environ.get('SEEN_FILTER_MAX_BITS', 1 << 25))
+
+WORD_BITS = 64
+
+# Sizes of filters other than SEEN_FILTER_BITS, so record_seen can address
+# their bits without reading them first; a stale entry costs one extra read
+_filter_sizes = {}
+
+
+def filter_bits(count):
+    """Filter size for count entries, with room to double before it needs a rebuild."""
+    bits = SEEN_FILTER_BITS
+    while bits < 2 * count * SEEN_FILTER_BITS_PER_ITEM and bits < SEEN_FILTER_MAX_BITS:
+        bits *= 2
+    return bits
+
+
+def over_capacity(bits, count):
+    return count * SEEN_FILTER_BITS_PER_ITEM > bits and bits < SEEN_FILTER_MAX_BITS
+
+
+def _remember_size(user_id, bits):
+    if bits == SEEN_FILTER_BITS:
+        _filter_sizes.pop(user_id, None)
+    else:
+        _filter_sizes[user_id] = bits
+
+
+def _to_int64(value):
+    # $bit works on signed 64-bit integers
+    return Int64(value - (1 << 64) if value >= (1 << 63) else value)
+
+
+class SeenFilter:
+    def __init__(self, words=None, bits=SEEN_FILTER_BITS, hashes=SEEN_FILTER_HASHES, scan_prefix=None):
+        self.bits = bits
+        self.hashes = hashes
+        word_count = bits // WORD_BITS
+        self.words = [w & 0xFFFFFFFFFFFFFFFF for w in words] if words else [0] * word_count
+        # {"key": [created_at, user_id], "interested_in": [...]}: every candidate up
+        # to key in search order has already been swiped on (see save_scan_prefix)
+        self.scan_prefix = scan_prefix
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(document["words"], document["bits"], document["hashes"], document.get("scan_prefix"))
+
+    def scan_start(self, user):
+        """Where a fresh creation-order search for user can start; None for the beginning."""
+        if not self.scan_prefix or self.scan_prefix.get("interested_in") != user.get("interested_in"):
+            return None
+        return self.scan_prefix["key"]
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.words[position // WORD_BITS] |= 1 << (position % WORD_BITS)
+
+    def might_contain(self, value):
+        return all(
+            self.words[position // WORD_BITS] >> (position % WORD_BITS) & 1
+            for position in self.positions(value)
+        )
+
+    def bit_update(self, values):
+        """Build a $bit update that sets the bits for all values, one mask per touched word."""
+        masks = {}
+        for value in values:
+            for position in self.positions(value):
+                word = position // WORD_BITS
+                masks[word] = masks.get(word, 0) | 1 << (position % WORD_BITS)
+        return {f"words.{word}": {"or": _to_int64(mask)} for word, mask in masks.items()}
+
+    def to_document(self, user_id, count):
+        return {
+            "_id": user_id,
+            "bits": self.bits,
+            "hashes": self.hashes,
+            "count": count,
+            "words": [_to_int64(w) for w in self.words],
+        }
+
+
+async def rebuild_seen_filter(db, user_id, scan_prefix=None):
+    """Build a user's filter from their interactions and archived dislikes; also the backfill path for existing users."""
+    interactions, archived = await asyncio.gather(
+        db.interactions.find({"user_id": user_id}, {"_id": 0, "target_user_id": 1}),
+        all_archived_targets(db, user_id)
+    )
+    count = len(interactions) + len(archived)
+    seen_filter = SeenFilter(bits=filter_bits(count), scan_prefix=scan_prefix)
+    for interaction in interactions:
+        seen_filter.add(interaction["target_user_id"])
+    for target in archived:
+        seen_filter.add(target)
+
+    document = seen_filter.to_document(user_id, count)
+    if scan_prefix:
+        document["scan_prefix"] = scan_prefix
+    await db[SEEN_FILTERS_COLLECTION].replace_one({"_id": user_id}, document, upsert=True)
+    _remember_size(user_id, seen_filter.bits)
+    return seen_filter
+
+
+async def load_seen_filter(db, user_id):
+    document = await db[SEEN_FILTERS_COLLECTION].find_one({"_id": user_id})
+    if (
+        not document
+        or document["hashes"] != SEEN_FILTER_HASHES
+        or document["bits"] < SEEN_FILTER_BITS
+        or over_capacity(document["bits"], document["count"])
+    ):
+        return await rebuild_seen_filter(db, user_id, document.get("scan_prefix") if document else None)
+    _remember_size(user_id, document["bits"])
+    return SeenFilter.from_document(document)
+
+
+async def _set_bits(db, user_id, bits, target_user_ids):
+    result = await db[SEEN_FILTERS_COLLECTION].update_one(
+        {"_id": user_id, "bits": bits, "hashes": SEEN_FILTER_HASHES},
+        {
+            "$bit": SeenFilter(bits=bits).bit_update(target_user_ids),
+            "$inc": {"count": len(target_user_ids)}
+        }
+    )
+    return result.matched_count > 0
+
+
+async def record_seen(db, user_id, target_user_ids):
+    """Set the filter bits for freshly recorded interactions."""
+    if await _set_bits(db, user_id, _filter_sizes.get(user_id, SEEN_FILTER_BITS), target_user_ids):
+        return
+    # Sized differently than remembered, e.g. grown by another instance
+    document = await db[SEEN_FILTERS_COLLECTION].find_one({"_id": user_id}, {"bits": 1, "hashes": 1})
+    if document and document["hashes"] == SEEN_FILTER_HASHES:
+        _remember_size(user_id, document["bits"])
+        if await _set_bits(db, user_id, document["bits"], target_user_ids):
+            return
+    # No filter yet (or built with other hashes). The interaction write may
+    # be running concurrently, so set these bits again after rebuilding
+    # rather than relying on the rebuild to see it.
+    seen_filter = await rebuild_seen_filter(db, user_id)
+    await db[SEEN_FILTERS_COLLECTION].update_one(
+        {"_id": user_id},
+        {"$bit": seen_filter.bit_update(target_user_ids)}
+    )
+
+
+async def save_scan_prefix(db, user, key):
+    """Record that every candidate up to key (in search order) has been swiped on.
+
+    Candidates are only ever added after existing ones in that order, so the
+    prefix stays seen; it is tied to interested_in, which defines the candidates.
+    A racing search may set an older key, which only costs a longer scan.
+    """
+    await db[SEEN_FILTERS_COLLECTION].update_one(
+        {"_id": user["user_id"]},
+        {"$set": {"scan_prefix": {"key": key, "interested_in": user.get("interested_in")}}}
+    )
+
+
+async def filter_unseen(db, user_id, seen_filter, candidate_ids):
+    """Return the subset of candidate_ids the user has not interacted with.
+
+    Bloom negatives are trusted; positives may be false, so they are checked
+    against interactions and the archived dislikes, each with a single query
+    bounded by the batch size.
+    """
+    maybe_seen = [c for c in candidate_ids if seen_filter.might_contain(c)]
+    if not maybe_seen:
+        return set(candidate_ids)
+
+    seen, archived = await asyncio.gather(
+        db.interactions.find(
+            {"user_id": user_id, "target_user_id": {"$in": maybe_seen}},
+            {"_id": 0, "target_user_id": 1}
+        ),
+        archived_targets(db, user_id, maybe_seen)
+    )
+    seen_ids = {interaction["target_user_id"] for interaction in seen} | archived
+    return {c for c in candidate_ids if c not in seen_ids}
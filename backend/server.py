@@ -1,23 +1,126 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 from typing import List, Optional
-from pydantic import BaseModel
-from pymongo import MongoClient
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
 import os
 from datetime import datetime
 import uuid
 import json
+import asyncio
 from pathlib import Path
-import shutil
 
-# MongoDB setup
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = MongoClient(MONGO_URL)
-db = client.dating_app
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from compaction import InteractionCompactor, archived_by
+import database
+from feed import FEED_ENABLED, FEED_LOW_WATERMARK, FeedBuilder, candidate_query, hydrate_feed, pop_feed
+from health import HealthMonitor, pool_stats
+import log
+from message_store import (
+    MESSAGE_SORT_FIELDS, MESSAGE_STORAGE, StorageWatch, find_message_key, insert_message, mark_read, newest_message_key,
+    read_messages
+)
+from metrics import MetricsMiddleware, in_flight_requests, registry as metrics_registry
+from migrations import SCHEMA_VERSION, run_migrations, schema_version
+from photo_files import PhotoFiles
+from photos import PhotoError, save_photo
+import photos as photo_pipeline
+from realtime import broker, dumps, publish_to_users, user_channel
+from pagination import BACKWARD, FORWARD, decode_cursor, encode_cursor, keyset_filter, sort_spec
+from ranking import rank_candidates
+from ratelimit import RATE_LIMIT_BACKEND, RateLimiter
+from responses import FastJSONResponse, parse_fields
+from seen_filter import filter_unseen, load_seen_filter, record_seen, save_scan_prefix
+from user_cache import get_cached_user, user_cache
+
+# Structured JSON logs, written from a background thread (see log.py)
+log.configure()
+logger = log.get_logger("server")
+metrics_registry.register_gauge("gora_log_records_dropped_total", "Log records dropped because the queue was full", log.dropped_count, kind="counter")
+
+# MongoDB setup (async access layer, see database.py)
+db = database.db
+
+# Per-user swipe and message budgets, checked before any database work (see ratelimit.py)
+rate_limiter = RateLimiter(shared=broker if RATE_LIMIT_BACKEND == "broker" else None)
+
+# Refills the ranked feed queues in the background (see feed.py)
+feed_builder = FeedBuilder(db)
+
+# Folds old dislikes into the interaction archive (see compaction.py)
+compactor = InteractionCompactor(db)
+storage_watch = StorageWatch(db)
+
+# Cached MongoDB ping and event-loop lag behind the readiness probe (see health.py)
+health_monitor = HealthMonitor(db, schema_version, SCHEMA_VERSION)
+metrics_registry.register_gauge("gora_http_requests_in_flight", "HTTP requests being handled", in_flight_requests)
+metrics_registry.register_gauge("gora_db_pool_connections_in_use", "MongoDB connections checked out", lambda: pool_stats.in_use)
+metrics_registry.register_gauge("gora_db_pool_wait_queue", "Operations waiting for a MongoDB connection", lambda: pool_stats.waiting)
+metrics_registry.register_gauge("gora_db_ping_ok", "1 if the last MongoDB ping succeeded", lambda: int(health_monitor.database_ok()))
+metrics_registry.register_gauge("gora_event_loop_lag_seconds", "Event-loop lag at the last sample", lambda: health_monitor.loop_lag)
+
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get('RUN_MIGRATIONS_ON_STARTUP', 'true').lower() == 'true'
+
+# Follow-up writes responses don't wait for, referenced until they finish
+background_tasks = set()
+
+def run_in_background(coro, description):
+    async def run():
+        try:
+            await coro
+        except Exception:
+            logger.exception("%s error", description)
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def prepare_database():
+    """Migrate the schema, then start the jobs that rely on it."""
+    if RUN_MIGRATIONS_ON_STARTUP:
+        try:
+            report = await run_migrations(db)
+            health_monitor.set_schema(report["to_version"])
+            logger.info(
+                "Schema version %s -> %s", report["from_version"], report["to_version"],
+                extra={"event": "migrations", "created_indexes": report["created"]}
+            )
+        except Exception as error:
+            # Chats and swipes rely on unique indexes for exactly-once upserts, so
+            # stay out of rotation (readiness fails) until the schema is current
+            health_monitor.set_schema(None, repr(error))
+            logger.exception("Migration error")
+    # Reconciles the dislike TTL on the index migration 11 creates
+    await compactor.start()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await health_monitor.start()
+    await broker.start()
+    await feed_builder.start()
+    await storage_watch.start()
+    # uvicorn only binds its socket once startup returns, so a long migration
+    # runs in the background: liveness answers meanwhile and readiness waits
+    # for the schema version
+    database_task = asyncio.create_task(prepare_database())
+    health_monitor.mark_started()
+    yield
+    await health_monitor.close()
+    database_task.cancel()
+    # Let follow-up writes of already answered requests land
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await compactor.close()
+    await storage_watch.close()
+    await feed_builder.close()
+    await broker.close()
+    photo_pipeline.shutdown()
+    database.close()
+    log.shutdown()
 
 # FastAPI app setup
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # CORS setup
 app.add_middleware(
@@ -28,12 +131,53 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-route latency and MongoDB usage, scraped from /api/metrics
+app.add_middleware(MetricsMiddleware)
+
+# Outermost, so every log line of a request carries its X-Request-ID
+app.add_middleware(log.RequestIdMiddleware)
+
 # Create uploads directory
 uploads_dir = Path("uploads")
 uploads_dir.mkdir(exist_ok=True)
 
-# Mount static files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Serve photos with immutable caching, ETags and range support (see photo_files.py)
+app.mount("/uploads", PhotoFiles(uploads_dir), name="uploads")
+
+SWIPE_ACTIONS = ["like", "dislike", "super_like"]
+LIKE_ACTIONS = ["like", "super_like"]
+BATCH_SWIPE_LIMIT = int(os.environ.get('BATCH_SWIPE_LIMIT', 100))
+
+# Candidate scanning for /api/search/users
+SEARCH_BATCH_SIZE = int(os.environ.get('SEARCH_BATCH_SIZE', 100))
+SEARCH_MAX_SCAN = int(os.environ.get('SEARCH_MAX_SCAN', 2000))
+RANK_POOL_SIZE = int(os.environ.get('RANK_POOL_SIZE', 300))
+SEARCH_PROJECTION = {
+    "user_id": 1,
+    "name": 1,
+    "age": 1,
+    "profile_photos": 1,
+    "profile_photo_variants": 1,
+    "bio": 1,
+    "selected_spokies": 1,
+    "location": 1,
+    "relationship_type": 1,
+    "created_at": 1
+}
+# Fields a search result can be narrowed to with fields=; the computed ones are added after the query
+SEARCH_FIELDS = set(SEARCH_PROJECTION) - {"created_at"} | {"_id", "distance_km", "match_score"}
+# Always fetched: keyset cursor, seen-set filtering and ranking depend on them
+SEARCH_REQUIRED_FIELDS = {"user_id", "created_at"}
+RANK_FIELDS = {"age", "selected_spokies", "relationship_type"}
+PROFILE_FIELDS = {
+    "_id", "user_id", "telegram_id", "name", "age", "gender", "orientation", "interested_in",
+    "relationship_type", "selected_spokies", "profile_photos", "profile_photo_variants", "bio",
+    "tokens", "location", "created_at", "updated_at", "is_active"
+}
+SEARCH_SORT_FIELDS = ["created_at", "user_id"]
+GEO_SEARCH_SORT_FIELDS = ["distance_m", "user_id"]
+CHAT_SORT_FIELDS = ["last_message_time", "chat_id"]
+RECEIVED_LIKE_SORT_FIELDS = ["is_super_like", "liked_at", "user_id"]
 
 # Pydantic models
 class UserRegistration(BaseModel):
@@ -54,20 +198,50 @@ class UserProfile(BaseModel):
     relationship_type: Optional[List[str]] = None
     selectedSpokies: Optional[List[int]] = None
 
+class LocationUpdate(BaseModel):
+    lat: float = Field(..., ge=-90, le=90)
+    lng: float = Field(..., ge=-180, le=180)
+
 class LikeRequest(BaseModel):
     target_user_id: str
     action: str  # "like", "dislike", "super_like"
 
+class BatchLikeRequest(BaseModel):
+    actions: List[LikeRequest]
+
 class ChatMessage(BaseModel):
     chat_id: str
     message: str
 
+class ReadReceipt(BaseModel):
+    # Defaults to the newest message in the chat
+    message_id: Optional[str] = None
+
 # API Endpoints
 
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now()}
 
+@app.get("/api/health/live")
+async def liveness_check():
+    # Answered by the event loop alone: restart only if this stops responding
+    return {"status": "alive", "timestamp": datetime.now()}
+
+@app.get("/api/health/ready")
+async def readiness_check():
+    # Cached state only, so probes cost no database round trip
+    ready, report = health_monitor.readiness(in_flight_requests(), database.MONGO_MAX_POOL_SIZE)
+    return FastJSONResponse(report, status_code=200 if ready else 503)
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return {"user_cache": user_cache.stats(), "feed_builder": feed_builder.stats(), "compactor": compactor.stats()}
+
+@app.get("/api/metrics")
+async def metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/auth/register")
 async def register_user(
     telegram_id: str = Form(...),
@@ -82,30 +256,24 @@ async def register_user(
     photos: List[UploadFile] = File(default=[])
 ):
     try:
-        print(f"🖼️ Received files: {len(photos) if photos else 0}")
+        logger.info("Received files", extra={"event": "files_received", "count": len(photos) if photos else 0})
         
         # Check if user already exists
-        existing_user = db.users.find_one({"telegram_id": telegram_id})
+        existing_user = await db.users.find_one({"telegram_id": telegram_id})
         if existing_user:
             raise HTTPException(status_code=400, detail="User already exists")
         
-        # Process photos
-        profile_photos = []
-        if photos and len(photos) > 0:
-            for photo in photos:
-                if photo.filename and photo.filename != "":
-                    # Generate unique filename
-                    file_extension = photo.filename.split(".")[-1]
-                    filename = f"{uuid.uuid4()}.{file_extension}"
-                    file_path = uploads_dir / filename
-                    
-                    # Save file
-                    with open(file_path, "wb") as buffer:
-                        shutil.copyfileobj(photo.file, buffer)
-                    
-                    photo_url = f"/uploads/{filename}"
-                    profile_photos.append(photo_url)
-                    print(f"✅ Photo saved: {photo_url}")
+        # Process photos in the worker pool: thumb/card/full variants, metadata stripped
+        uploads = [photo for photo in photos or [] if photo.filename]
+        try:
+            profile_photo_variants = await asyncio.gather(*(save_photo(photo, uploads_dir) for photo in uploads))
+        except PhotoError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        
+        # profile_photos keeps plain URLs for existing clients; list views use the variants
+        profile_photos = [variants["full"] for variants in profile_photo_variants]
+        for photo_url in profile_photos:
+            logger.info("Photo saved", extra={"event": "photo_saved", "url": photo_url})
         
         # Parse JSON fields
         try:
@@ -130,6 +298,7 @@ async def register_user(
             "relationship_type": relationship_type_parsed,
             "selected_spokies": selectedSpokies_parsed,
             "profile_photos": profile_photos,
+            "profile_photo_variants": list(profile_photo_variants),
             "bio": bio,
             "tokens": default_tokens,
             "location": {"lat": None, "lng": None},
@@ -139,45 +308,47 @@ async def register_user(
         }
         
         # Insert user into database
-        result = db.users.insert_one(user_data)
+        result = await db.users.insert_one(user_data)
+        user_cache.invalidate(telegram_id)
         
         if result.inserted_id:
-            print("✅ User successfully registered!")
+            logger.info("User registered", extra={"event": "user_registered", "telegram_id": telegram_id})
             return {"message": "User registered successfully!", "telegram_id": telegram_id}
         else:
             raise HTTPException(status_code=500, detail="Failed to register user")
             
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Registration error: {error}")
+    except Exception:
+        logger.exception("Registration error")
         raise HTTPException(status_code=500, detail="Failed to register user")
 
 @app.get("/api/profile/{telegram_id}")
-async def get_user_profile(telegram_id: str):
+async def get_user_profile(telegram_id: str, fields: Optional[str] = None):
     try:
-        user = db.users.find_one({"telegram_id": telegram_id})
+        # fields= narrows the document inside Mongo; without it the whole profile is returned
+        selected = parse_fields(fields, PROFILE_FIELDS)
+        projection = None
+        if selected:
+            projection = {name: 1 for name in selected}
+            if "_id" not in projection:
+                projection["_id"] = 0
+        
+        user = await db.users.find_one({"telegram_id": telegram_id}, projection)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Convert ObjectId to string for JSON serialization
-        user["_id"] = str(user["_id"])
-        return user
+        return FastJSONResponse(user)
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Get profile error: {error}")
+    except Exception:
+        logger.exception("Get profile error")
         raise HTTPException(status_code=500, detail="Failed to get user profile")
 
 @app.put("/api/profile/{telegram_id}")
 async def update_user_profile(telegram_id: str, profile_data: UserProfile):
     try:
-        # Find user
-        user = db.users.find_one({"telegram_id": telegram_id})
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
         # Prepare update data
         update_data = {}
         if profile_data.name is not None:
@@ -194,10 +365,13 @@ async def update_user_profile(telegram_id: str, profile_data: UserProfile):
         update_data["updated_at"] = datetime.now()
         
         # Update user
-        result = db.users.update_one(
+        result = await db.users.update_one(
             {"telegram_id": telegram_id},
             {"$set": update_data}
         )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+        user_cache.invalidate(telegram_id)
         
         if result.modified_count > 0:
             return {"message": "Profile updated successfully"}
@@ -206,216 +380,608 @@ async def update_user_profile(telegram_id: str, profile_data: UserProfile):
             
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Update profile error: {error}")
+    except Exception:
+        logger.exception("Update profile error")
         raise HTTPException(status_code=500, detail="Failed to update profile")
 
+@app.put("/api/profile/{telegram_id}/location")
+async def update_user_location(telegram_id: str, location: LocationUpdate):
+    try:
+        # Keep the legacy lat/lng object and a GeoJSON point for the 2dsphere index
+        result = await db.users.update_one(
+            {"telegram_id": telegram_id},
+            {"$set": {
+                "location": {"lat": location.lat, "lng": location.lng},
+                "geo": {"type": "Point", "coordinates": [location.lng, location.lat]},
+                "updated_at": datetime.now()
+            }}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+        user_cache.invalidate(telegram_id)
+        
+        return {"message": "Location updated successfully"}
+        
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Update location error")
+        raise HTTPException(status_code=500, detail="Failed to update location")
+
+async def fetch_candidate_batch(search_query, last_key, near=None, max_distance_km=None, projection=SEARCH_PROJECTION):
+    """Next batch of search candidates after last_key, in creation order or nearest-first."""
+    if near is None:
+        batch_query = dict(search_query)
+        if last_key is not None:
+            batch_query.update(keyset_filter(SEARCH_SORT_FIELDS, last_key))
+        return await db.users.find(
+            batch_query,
+            projection,
+            sort=sort_spec(SEARCH_SORT_FIELDS),
+            limit=SEARCH_BATCH_SIZE
+        )
+    
+    geo_near = {
+        "near": near,
+        "distanceField": "distance_m",
+        "maxDistance": max_distance_km * 1000,
+        "query": search_query,
+        "key": "geo",
+        "spherical": True
+    }
+    pipeline = [{"$geoNear": geo_near}]
+    if last_key is not None:
+        geo_near["minDistance"] = last_key[0]
+        pipeline.append({"$match": keyset_filter(GEO_SEARCH_SORT_FIELDS, last_key)})
+    pipeline += [
+        {"$sort": dict(sort_spec(GEO_SEARCH_SORT_FIELDS))},
+        {"$limit": SEARCH_BATCH_SIZE},
+        {"$project": {**projection, "distance_m": 1}}
+    ]
+    return await db.users.aggregate(pipeline)
+
+def shape_search_results(users, selected):
+    for user in users:
+        user.pop("created_at", None)
+        if "distance_m" in user:
+            user["distance_km"] = round(user.pop("distance_m") / 1000, 1)
+    if selected:
+        users = [{name: user[name] for name in selected if name in user} for user in users]
+    return users
+
 @app.get("/api/search/users")
-async def search_users(telegram_id: str, skip: int = 0, limit: int = 10):
+async def search_users(
+    telegram_id: str,
+    skip: int = 0,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    max_distance_km: Optional[float] = None,
+    rank: bool = False,
+    fields: Optional[str] = None
+):
     try:
+        # Fetch only the requested fields plus what paging, filtering and ranking need
+        selected = parse_fields(fields, SEARCH_FIELDS)
+        projection = SEARCH_PROJECTION
+        if selected:
+            projection = {name: 1 for name in (set(selected) & set(SEARCH_PROJECTION)) | SEARCH_REQUIRED_FIELDS | (RANK_FIELDS if rank else set())}
+            if "_id" not in selected:
+                projection["_id"] = 0
+        
         # Get current user to filter based on preferences
-        current_user = db.users.find_one({"telegram_id": telegram_id})
+        current_user = await get_cached_user(db, telegram_id)
         if not current_user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get users that current user has already interacted with
-        user_interactions = db.interactions.find({"user_id": current_user["user_id"]})
-        interacted_user_ids = [interaction["target_user_id"] for interaction in user_interactions]
+        # The first page of the ranked feed comes from the user's precomputed queue
+        if rank and FEED_ENABLED and not cursor and not skip and max_distance_km is None:
+            queued, remaining = await pop_feed(db, current_user["user_id"], limit)
+            if remaining < FEED_LOW_WATERMARK:
+                feed_builder.request(current_user["user_id"])
+            users = await hydrate_feed(db, current_user["user_id"], queued, projection) if queued else []
+            if users:
+                # Re-scored only to attach match_score; the queue already holds the best first
+                users = rank_candidates(current_user, users, limit)
+                return FastJSONResponse({"users": shape_search_results(users, selected), "next_cursor": None})
+            # Empty or fully stale queue: serve this page live while it refills
         
-        # Build search query
-        search_query = {
-            "telegram_id": {"$ne": telegram_id},  # Not current user
-            "user_id": {"$nin": interacted_user_ids},  # Not already interacted
-            "is_active": True
-        }
+        # Compact set of users the current user has already interacted with
+        seen = await load_seen_filter(db, current_user["user_id"])
         
-        # Filter by interests if specified
-        if current_user.get("interested_in"):
-            search_query["gender"] = {"$in": current_user["interested_in"]}
+        # Other active users of the genders the current user is interested in
+        search_query = candidate_query(current_user)
         
-        # Get users
-        users = list(db.users.find(
-            search_query,
-            {
-                "user_id": 1,
-                "name": 1,
-                "age": 1,
-                "profile_photos": 1,
-                "bio": 1,
-                "selected_spokies": 1,
-                "location": 1
-            }
-        ).skip(skip).limit(limit))
+        # Proximity search runs nearest-first inside the database
+        near = None
+        sort_fields = SEARCH_SORT_FIELDS
+        if max_distance_km is not None:
+            near = current_user.get("geo")
+            if not near:
+                raise HTTPException(status_code=400, detail="Location is not set for this user")
+            sort_fields = GEO_SEARCH_SORT_FIELDS
+        
+        # Scan candidates in keyset order, dropping already-seen users in
+        # memory, until the page is full or the scan budget is spent
+        last_key = decode_cursor(cursor, len(sort_fields))[0] if cursor else None
+        
+        # A fresh creation-order scan starts after the oldest candidates the user
+        # has already swiped on, and extends that prefix as it confirms more, so
+        # old swipes are paid for once rather than on every call
+        extend_prefix = last_key is None and near is None
+        if extend_prefix:
+            last_key = seen.scan_start(current_user)
         
-        # Convert ObjectId to string
-        for user in users:
-            user["_id"] = str(user["_id"])
+        # Ranked mode gathers a larger pool of unseen candidates and returns its best matches
+        page_size = max(RANK_POOL_SIZE, limit) if rank else limit
+        users = []
+        to_skip = 0 if rank else skip
+        # Rows extending the seen prefix or consumed by skip don't count against the budget
+        scanned = 0
+        exhausted = False
+        while len(users) < page_size and scanned < SEARCH_MAX_SCAN:
+            batch = await fetch_candidate_batch(search_query, last_key, near, max_distance_km, projection)
+            
+            unseen = await filter_unseen(db, current_user["user_id"], seen, [u["user_id"] for u in batch]) if batch else set()
+            prefix_key = None
+            for user in batch:
+                # Continue the next page right after the last candidate looked at
+                last_key = [user.get(field) for field in sort_fields]
+                if user["user_id"] not in unseen:
+                    if extend_prefix:
+                        prefix_key = last_key
+                    else:
+                        scanned += 1
+                    continue
+                extend_prefix = False
+                if to_skip > 0:
+                    to_skip -= 1
+                    continue
+                scanned += 1
+                users.append(user)
+                if len(users) == page_size:
+                    break
+            # Saved per batch, so a long first extension still makes progress if cut short
+            if prefix_key is not None:
+                await save_scan_prefix(db, current_user, prefix_key)
+            
+            if len(batch) < SEARCH_BATCH_SIZE and len(users) < page_size:
+                exhausted = True
+                break
         
-        return {"users": users}
+        next_cursor = encode_cursor(last_key) if last_key is not None and not exhausted else None
+        
+        if rank:
+            # Swiped candidates drop out through the seen-set, so the next
+            # ranked call naturally serves the following best matches
+            users = rank_candidates(current_user, users, limit)
+            next_cursor = None
+        
+        return FastJSONResponse({"users": shape_search_results(users, selected), "next_cursor": next_cursor})
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Search users error: {error}")
+    except Exception:
+        logger.exception("Search users error")
         raise HTTPException(status_code=500, detail="Failed to search users")
 
+def chat_key_for(user_id, other_user_id):
+    """Deterministic key for the one chat two users can share."""
+    return ":".join(sorted([user_id, other_user_id]))
+
+async def ensure_match_chat(user_id, other_user_id):
+    """Create the pair's chat exactly once; returns (chat_id, created)."""
+    now = datetime.now()
+    chat_data = {
+        "chat_id": str(uuid.uuid4()),
+        "chat_key": chat_key_for(user_id, other_user_id),
+        "participants": [user_id, other_user_id],
+        "created_at": now,
+        "last_message": None,
+        "last_message_time": now,
+        "storage": MESSAGE_STORAGE
+    }
+    try:
+        existing = await db.chats.find_one_and_update(
+            {"chat_key": chat_data["chat_key"]},
+            {"$setOnInsert": chat_data},
+            upsert=True,
+            projection={"chat_id": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race against the other user's like; their chat stands
+        existing = await db.chats.find_one({"chat_key": chat_data["chat_key"]}, {"chat_id": 1})
+    
+    if existing:
+        return existing["chat_id"], False
+    return chat_data["chat_id"], True
+
+def pending_like_id(target_user_id, user_id):
+    return f"{target_user_id}:{user_id}"
+
+def clear_pending_likes(ids, now):
+    """Delete answered pending likes in the background; a like re-recorded after now is kept."""
+    if ids:
+        run_in_background(
+            db.pending_likes.bulk_write(
+                [DeleteOne({"_id": _id, "liked_at": {"$lte": now}}) for _id in ids], ordered=False
+            ),
+            "Pending likes cleanup"
+        )
+
+async def apply_swipes(current_user, swipes):
+    """Record ordered swipes with one bulk write and resolve matches with one reverse-like query.
+
+    A batch without likes is one round trip. Pending likes it answered are
+    cleared in the background.
+
+    Returns {target_user_id: chat_id or None} for the final state of each target.
+    """
+    user_id = current_user["user_id"]
+    now = datetime.now()
+    
+    # One upsert per (user, target) pair, so double taps update the existing
+    # record instead of adding another; ordered, so the last swipe on a target wins
+    requests = [
+        UpdateOne(
+            {"user_id": user_id, "target_user_id": swipe.target_user_id},
+            {
+                "$set": {"action": swipe.action, "timestamp": now},
+                "$setOnInsert": {"interaction_id": str(uuid.uuid4())}
+            },
+            upsert=True
+        )
+        for swipe in swipes
+    ]
+    final_actions = {swipe.target_user_id: swipe.action for swipe in swipes}
+    results = {target: None for target in final_actions}
+    liked = [target for target, action in final_actions.items() if action in LIKE_ACTIONS]
+    
+    # This user's likes are pending until their target answers (the list
+    # behind get_received_likes). Recorded before the reverse-swipe check
+    # below, so a concurrent answer either sees them or is seen there.
+    writes = [
+        db.interactions.bulk_write(requests, ordered=True),
+        record_seen(db, user_id, list(final_actions))
+    ]
+    if liked:
+        writes.append(db.pending_likes.bulk_write([
+            UpdateOne(
+                {"_id": pending_like_id(target, user_id)},
+                {"$set": {
+                    "target_user_id": target,
+                    "user_id": user_id,
+                    "is_super_like": final_actions[target] == "super_like",
+                    "liked_at": now
+                }},
+                upsert=True
+            )
+            for target in liked
+        ], ordered=False))
+    await asyncio.gather(*writes)
+    
+    # Likes these targets sent this user are answered now, as are this user's
+    # likes it took back. Cleared after the interaction write, so a concurrent
+    # like either sees that write or its entry is cleared here.
+    clear_pending_likes(
+        [pending_like_id(user_id, target) for target in final_actions]
+        + [pending_like_id(target, user_id) for target, action in final_actions.items() if action not in LIKE_ACTIONS],
+        now
+    )
+    if not liked:
+        return results
+    
+    # Check which liked targets already swiped on the current user
+    reverse_swipes, archived = await asyncio.gather(
+        db.interactions.find(
+            {"user_id": {"$in": liked}, "target_user_id": user_id},
+            {"_id": 0, "user_id": 1, "action": 1}
+        ),
+        archived_by(db, liked, user_id)
+    )
+    answered = {swipe["user_id"] for swipe in reverse_swipes} | archived
+    clear_pending_likes([pending_like_id(target, user_id) for target in answered], now)
+    matched = [swipe["user_id"] for swipe in reverse_swipes if swipe["action"] in LIKE_ACTIONS]
+    
+    # Create chat rooms for matches; concurrent mutual likes share one chat
+    chats = await asyncio.gather(*(ensure_match_chat(user_id, target) for target in matched))
+    for target, (chat_id, created) in zip(matched, chats):
+        results[target] = chat_id
+        if created:
+            # Let both users know right away if they are connected
+            await publish_to_users([user_id, target], {
+                "type": "match",
+                "chat_id": chat_id,
+                "participants": [user_id, target]
+            })
+    return results
+
 @app.post("/api/like")
 async def handle_like(like_request: LikeRequest, telegram_id: str):
     try:
+        if like_request.action not in SWIPE_ACTIONS:
+            raise HTTPException(status_code=400, detail="Invalid action")
+        await rate_limiter.check("like", telegram_id)
+        
         # Get current user
-        current_user = db.users.find_one({"telegram_id": telegram_id})
+        current_user = await get_cached_user(db, telegram_id)
         if not current_user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Record interaction
-        interaction_data = {
-            "interaction_id": str(uuid.uuid4()),
-            "user_id": current_user["user_id"],
-            "target_user_id": like_request.target_user_id,
-            "action": like_request.action,
-            "timestamp": datetime.now()
+        results = await apply_swipes(current_user, [like_request])
+        
+        return {
+            "success": True,
+            "is_match": results[like_request.target_user_id] is not None,
+            "action": like_request.action
         }
         
-        db.interactions.insert_one(interaction_data)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Like error")
+        raise HTTPException(status_code=500, detail="Failed to process like")
+
+@app.post("/api/like/batch")
+async def handle_like_batch(batch: BatchLikeRequest, telegram_id: str):
+    try:
+        if not batch.actions:
+            return {"success": True, "results": []}
+        if len(batch.actions) > BATCH_SWIPE_LIMIT:
+            raise HTTPException(status_code=400, detail=f"At most {BATCH_SWIPE_LIMIT} actions per batch")
+        if any(swipe.action not in SWIPE_ACTIONS for swipe in batch.actions):
+            raise HTTPException(status_code=400, detail="Invalid action")
+        # Shares the single-swipe budget, one token per action
+        await rate_limiter.check("like", telegram_id, cost=len(batch.actions))
         
-        # Check if it's a match (both users liked each other)
-        is_match = False
-        if like_request.action in ["like", "super_like"]:
-            # Check if target user also liked current user
-            reverse_like = db.interactions.find_one({
-                "user_id": like_request.target_user_id,
-                "target_user_id": current_user["user_id"],
-                "action": {"$in": ["like", "super_like"]}
-            })
-            
-            if reverse_like:
-                is_match = True
-                # Create chat room for match
-                chat_data = {
-                    "chat_id": str(uuid.uuid4()),
-                    "participants": [current_user["user_id"], like_request.target_user_id],
-                    "created_at": datetime.now(),
-                    "last_message": None,
-                    "last_message_time": datetime.now()
-                }
-                db.chats.insert_one(chat_data)
+        # Get current user
+        current_user = await get_cached_user(db, telegram_id)
+        if not current_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        results = await apply_swipes(current_user, batch.actions)
         
         return {
             "success": True,
-            "is_match": is_match,
-            "action": like_request.action
+            "results": [
+                {
+                    "target_user_id": swipe.target_user_id,
+                    "action": swipe.action,
+                    "is_match": swipe.action in LIKE_ACTIONS and results[swipe.target_user_id] is not None,
+                    "chat_id": results[swipe.target_user_id] if swipe.action in LIKE_ACTIONS else None
+                }
+                for swipe in batch.actions
+            ]
         }
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Like error: {error}")
-        raise HTTPException(status_code=500, detail="Failed to process like")
+    except Exception:
+        logger.exception("Batch like error")
+        raise HTTPException(status_code=500, detail="Failed to process likes")
 
 @app.get("/api/likes/received/{telegram_id}")
-async def get_received_likes(telegram_id: str):
+async def get_received_likes(
+    telegram_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    count_only: bool = False
+):
     try:
         # Get current user
-        current_user = db.users.find_one({"telegram_id": telegram_id})
+        current_user = await get_cached_user(db, telegram_id)
         if not current_user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get users who liked current user
-        likes = list(db.interactions.find({
-            "target_user_id": current_user["user_id"],
-            "action": {"$in": ["like", "super_like"]}
-        }))
+        # Cheap badge mode: an index count over the pending likes apply_swipes maintains
+        if count_only:
+            count = await db.pending_likes.count_documents({"target_user_id": current_user["user_id"]})
+            return {"count": count}
         
-        # Get user details for those who liked
-        liker_ids = [like["user_id"] for like in likes]
-        likers = list(db.users.find(
-            {"user_id": {"$in": liker_ids}},
+        # pending_likes holds one entry per liker the current user hasn't
+        # answered yet, indexed in page order: super likes first, then most recent
+        query = {"target_user_id": current_user["user_id"]}
+        if cursor:
+            key, _ = decode_cursor(cursor, len(RECEIVED_LIKE_SORT_FIELDS))
+            query.update(keyset_filter(RECEIVED_LIKE_SORT_FIELDS, key, BACKWARD))
+        likes = await db.pending_likes.find(
+            query,
+            {"_id": 0, "user_id": 1, "is_super_like": 1, "liked_at": 1},
+            sort=sort_spec(RECEIVED_LIKE_SORT_FIELDS, BACKWARD),
+            limit=limit
+        )
+        
+        # Get user details for those who liked, keeping the ranked order
+        likers = await db.users.find(
+            {"user_id": {"$in": [like["user_id"] for like in likes]}},
             {
                 "user_id": 1,
                 "name": 1,
                 "age": 1,
                 "profile_photos": 1,
+                "profile_photo_variants": 1,
                 "bio": 1,
                 "location": 1
             }
-        ))
+        )
+        likers_by_id = {liker["user_id"]: liker for liker in likers}
         
-        # Convert ObjectId to string
-        for liker in likers:
+        ranked_likers = []
+        for like in likes:
+            liker = likers_by_id.get(like["user_id"])
+            if not liker:
+                continue
             liker["_id"] = str(liker["_id"])
+            liker["is_super_like"] = bool(like["is_super_like"])
+            liker["liked_at"] = like["liked_at"]
+            ranked_likers.append(liker)
+        
+        next_cursor = None
+        if len(likes) == limit:
+            next_cursor = encode_cursor([likes[-1][field] for field in RECEIVED_LIKE_SORT_FIELDS], BACKWARD)
         
-        return {"likes": likers}
+        return {"likes": ranked_likers, "next_cursor": next_cursor}
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Get received likes error: {error}")
+    except Exception:
+        logger.exception("Get received likes error")
         raise HTTPException(status_code=500, detail="Failed to get received likes")
 
+def participant_avatar(user):
+    """Smallest available photo URL for avatars; older users only have originals."""
+    variants = user.get("profile_photo_variants")
+    if variants:
+        return variants[0]["thumb"]
+    return user["profile_photos"][0] if user.get("profile_photos") else None
+
 @app.get("/api/chats/{telegram_id}")
-async def get_user_chats(telegram_id: str):
+async def get_user_chats(
+    telegram_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=100),
+    cursor: Optional[str] = None
+):
     try:
         # Get current user
-        current_user = db.users.find_one({"telegram_id": telegram_id})
+        current_user = await get_cached_user(db, telegram_id)
         if not current_user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get user's chats
-        chats = list(db.chats.find({
-            "participants": current_user["user_id"]
-        }).sort("last_message_time", -1))
+        # Get the user's chats, most recent first; paged only when the client
+        # asks for a limit, since older clients expect the whole list
+        query = {"participants": current_user["user_id"]}
+        if cursor:
+            key, _ = decode_cursor(cursor, len(CHAT_SORT_FIELDS))
+            query.update(keyset_filter(CHAT_SORT_FIELDS, key, BACKWARD))
+        chats = await db.chats.find(
+            query,
+            sort=sort_spec(CHAT_SORT_FIELDS, BACKWARD),
+            limit=limit or 0
+        )
+        
+        # Fetch every other participant in one query and join in memory
+        other_ids = {
+            chat["chat_id"]: next((p for p in chat["participants"] if p != current_user["user_id"]), None)
+            for chat in chats
+        }
+        participants = await db.users.find(
+            {"user_id": {"$in": [p for p in other_ids.values() if p]}},
+            {"_id": 0, "user_id": 1, "name": 1, "profile_photos": 1, "profile_photo_variants": 1}
+        )
+        participants_by_id = {p["user_id"]: p for p in participants}
         
-        # Get participant details for each chat
         for chat in chats:
-            other_participant_id = next(p for p in chat["participants"] if p != current_user["user_id"])
-            participant = db.users.find_one(
-                {"user_id": other_participant_id},
-                {"name": 1, "profile_photos": 1}
-            )
+            participant = participants_by_id.get(other_ids[chat["chat_id"]])
             if participant:
                 chat["participant_name"] = participant["name"]
-                chat["participant_photo"] = participant["profile_photos"][0] if participant["profile_photos"] else None
+                chat["participant_photo"] = participant_avatar(participant)
             
+            # The counter can dip below zero briefly while a send and a read race
+            chat["unread_count"] = max((chat.get("unread_counts") or {}).get(current_user["user_id"], 0), 0)
+            
+            # Resume point for fetching only messages after what was already read
+            chat["read_cursor"] = read_cursor((chat.get("read_watermarks") or {}).get(current_user["user_id"]))
             chat["_id"] = str(chat["_id"])
         
-        return {"chats": chats}
+        next_cursor = None
+        if limit and len(chats) == limit:
+            next_cursor = encode_cursor([chats[-1][field] for field in CHAT_SORT_FIELDS], BACKWARD)
+        
+        return {"chats": chats, "next_cursor": next_cursor}
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Get chats error: {error}")
+    except Exception:
+        logger.exception("Get chats error")
         raise HTTPException(status_code=500, detail="Failed to get chats")
 
+@app.get("/api/chats/{telegram_id}/unread")
+async def get_unread_total(telegram_id: str):
+    try:
+        current_user = await get_cached_user(db, telegram_id)
+        if not current_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        # App badge: sum the maintained per-chat counters instead of counting messages
+        counter = f"$unread_counts.{current_user['user_id']}"
+        totals = await db.chats.aggregate([
+            {"$match": {"participants": current_user["user_id"], f"unread_counts.{current_user['user_id']}": {"$gt": 0}}},
+            {"$group": {"_id": None, "unread_total": {"$sum": counter}, "unread_chats": {"$sum": 1}}}
+        ])
+        
+        if not totals:
+            return {"unread_total": 0, "unread_chats": 0}
+        return {"unread_total": totals[0]["unread_total"], "unread_chats": totals[0]["unread_chats"]}
+        
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Get unread total error")
+        raise HTTPException(status_code=500, detail="Failed to get unread total")
+
 @app.get("/api/chats/{chat_id}/messages")
-async def get_chat_messages(chat_id: str, skip: int = 0, limit: int = 50):
+async def get_chat_messages(
+    chat_id: str,
+    skip: int = 0,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    latest: bool = False
+):
     try:
-        # Get messages for chat
-        messages = list(db.messages.find({
-            "chat_id": chat_id
-        }).sort("timestamp", 1).skip(skip).limit(limit))
+        # Keyset mode: continue from a cursor, or start backwards from the newest message
+        key = None
+        direction = FORWARD
+        if cursor:
+            key, direction = decode_cursor(cursor, len(MESSAGE_SORT_FIELDS))
+        elif latest:
+            direction = BACKWARD
         
-        # Convert ObjectId to string
+        # The chat records whether its messages are documents or buckets; no
+        # need to look while every chat still stores documents
+        chat = None
+        if storage_watch.any_bucketed:
+            chat = await db.chats.find_one({"chat_id": chat_id}, {"chat_id": 1, "storage": 1})
+        messages = await read_messages(db, chat_id, chat, key, direction, skip, limit)
+        
+        if direction == BACKWARD:
+            # Return pages in chronological order; the cursor points past the oldest one
+            messages.reverse()
+            has_more = len(messages) == limit
+            edge = messages[0] if messages else None
+        else:
+            # Forward cursors are returned even on a short page so clients can poll for new messages
+            has_more = bool(messages)
+            edge = messages[-1] if messages else None
+        
+        next_cursor = None
+        if has_more and edge is not None:
+            next_cursor = encode_cursor([edge[field] for field in MESSAGE_SORT_FIELDS], direction)
+        
+        # Convert ObjectId to string; bucketed messages have none
         for message in messages:
-            message["_id"] = str(message["_id"])
+            if "_id" in message:
+                message["_id"] = str(message["_id"])
         
-        return {"messages": messages}
+        return {"messages": messages, "next_cursor": next_cursor}
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Get chat messages error: {error}")
+    except Exception:
+        logger.exception("Get chat messages error")
         raise HTTPException(status_code=500, detail="Failed to get chat messages")
 
 @app.post("/api/chats/{chat_id}/messages")
 async def send_message(chat_id: str, message_data: ChatMessage, telegram_id: str):
     try:
+        await rate_limiter.check("message", telegram_id)
+        
         # Get current user
-        current_user = db.users.find_one({"telegram_id": telegram_id})
+        current_user = await get_cached_user(db, telegram_id)
         if not current_user:
             raise HTTPException(status_code=404, detail="User not found")
         
         # Verify user is participant in chat
-        chat = db.chats.find_one({"chat_id": chat_id})
+        chat = await db.chats.find_one({"chat_id": chat_id})
         if not chat or current_user["user_id"] not in chat["participants"]:
             raise HTTPException(status_code=403, detail="Not authorized to send messages in this chat")
         
@@ -429,27 +995,156 @@ async def send_message(chat_id: str, message_data: ChatMessage, telegram_id: str
             "is_read": False
         }
         
-        db.messages.insert_one(message)
+        await insert_message(db, chat, message)
         
-        # Update chat's last message
-        db.chats.update_one(
+        recipients = [p for p in chat["participants"] if p != current_user["user_id"]]
+        
+        # Update chat's last message and bump the recipients' unread counters in the same write
+        await db.chats.update_one(
             {"chat_id": chat_id},
             {
                 "$set": {
                     "last_message": message_data.message,
-                    "last_message_time": datetime.now()
-                }
+                    "last_message_time": message["timestamp"],
+                    "last_message_sender_id": message["sender_id"]
+                },
+                "$inc": {f"unread_counts.{p}": 1 for p in recipients}
             }
         )
         
+        # Push to the other participants' open sockets once the message is fully recorded
+        await publish_to_users(recipients, {
+            "type": "message",
+            "chat_id": chat_id,
+            "message": {
+                "message_id": message["message_id"],
+                "sender_id": message["sender_id"],
+                "message": message["message"],
+                "timestamp": message["timestamp"]
+            }
+        })
+        
         return {"message": "Message sent successfully", "message_id": message["message_id"]}
         
     except HTTPException:
         raise
-    except Exception as error:
-        print(f"❌ Send message error: {error}")
+    except Exception:
+        logger.exception("Send message error")
         raise HTTPException(status_code=500, detail="Failed to send message")
 
+def read_cursor(watermark):
+    if not watermark:
+        return None
+    return encode_cursor([watermark[field] for field in MESSAGE_SORT_FIELDS], FORWARD)
+
+async def mark_chat_read(chat, user_id, message_id=None):
+    """Mark the other participants' messages up to message_id (default: the newest) as read.
+    
+    Advances the reader's per-chat watermark and notifies the other participants.
+    Returns (marked_count, watermark).
+    """
+    chat_id = chat["chat_id"]
+    if message_id:
+        upto = await find_message_key(db, chat, message_id)
+        if not upto:
+            raise HTTPException(status_code=404, detail="Message not found")
+    else:
+        upto = await newest_message_key(db, chat)
+    
+    current = (chat.get("read_watermarks") or {}).get(user_id)
+    if not upto or (current and [current[f] for f in MESSAGE_SORT_FIELDS] >= [upto[f] for f in MESSAGE_SORT_FIELDS]):
+        # Nothing newer than what this user has already read
+        return 0, current
+    
+    marked = await mark_read(db, chat, user_id, upto, since=current)
+    
+    # Decrement by exactly what was flipped rather than resetting to zero, so a
+    # message sent while this runs still counts as unread once its $inc lands
+    if marked:
+        await db.chats.update_one(
+            {"chat_id": chat_id},
+            {"$inc": {f"unread_counts.{user_id}": -marked}}
+        )
+    
+    # Only ever move the watermark forward, even if an older receipt lands late
+    field = f"read_watermarks.{user_id}"
+    await db.chats.update_one(
+        {"chat_id": chat_id, "$or": [{field: {"$exists": False}}, {f"{field}.timestamp": {"$lt": upto["timestamp"]}}]},
+        {"$set": {field: upto}}
+    )
+    
+    recipients = [p for p in chat["participants"] if p != user_id]
+    await publish_to_users(recipients, {
+        "type": "read",
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "message_id": upto["message_id"],
+        "timestamp": upto["timestamp"]
+    })
+    return marked, upto
+
+@app.post("/api/chats/{chat_id}/read")
+async def mark_messages_read(chat_id: str, receipt: ReadReceipt, telegram_id: str):
+    try:
+        current_user = await get_cached_user(db, telegram_id)
+        if not current_user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        chat = await db.chats.find_one({"chat_id": chat_id}, {"chat_id": 1, "participants": 1, "read_watermarks": 1, "storage": 1})
+        if not chat or current_user["user_id"] not in chat["participants"]:
+            raise HTTPException(status_code=403, detail="Not authorized to read this chat")
+        
+        marked, watermark = await mark_chat_read(chat, current_user["user_id"], receipt.message_id)
+        
+        return {"marked": marked, "watermark": watermark, "read_cursor": read_cursor(watermark)}
+        
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Mark read error")
+        raise HTTPException(status_code=500, detail="Failed to mark messages as read")
+
+@app.websocket("/api/ws/{telegram_id}")
+async def realtime_socket(websocket: WebSocket, telegram_id: str):
+    current_user = await get_cached_user(db, telegram_id)
+    if not current_user:
+        await websocket.close(code=4404)
+        return
+    
+    await websocket.accept()
+    channel = user_channel(current_user["user_id"])
+    queue = broker.subscribe(channel)
+    
+    async def push_events():
+        while True:
+            event = await queue.get()
+            await websocket.send_text(dumps(event))
+    
+    pusher = asyncio.create_task(push_events())
+    try:
+        while True:
+            frame = await websocket.receive_json()
+            if frame.get("type") == "ping":
+                await websocket.send_text(dumps({"type": "pong"}))
+            elif frame.get("type") == "read":
+                # Same path as POST /api/chats/{chat_id}/read, which also notifies the other side
+                chat = await db.chats.find_one(
+                    {"chat_id": frame.get("chat_id")}, {"chat_id": 1, "participants": 1, "read_watermarks": 1, "storage": 1}
+                )
+                if not chat or current_user["user_id"] not in chat["participants"]:
+                    continue
+                try:
+                    await mark_chat_read(chat, current_user["user_id"], frame.get("message_id"))
+                except HTTPException:
+                    continue
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.exception("WebSocket error")
+    finally:
+        pusher.cancel()
+        broker.unsubscribe(channel, queue)
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get('PORT', 8000))
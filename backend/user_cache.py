@@ -0,0 +1,95 @@
+import os
+import time
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+
+# Identity and hot profile fields needed by the swipe, search and chat paths
+USER_CACHE_PROJECTION = {
+    "_id": 0,
+    "user_id": 1,
+    "telegram_id": 1,
+    "name": 1,
+    "age": 1,
+    "gender": 1,
+    "interested_in": 1,
+    "relationship_type": 1,
+    "selected_spokies": 1,
+    "profile_photos": 1,
+    "geo": 1,
+    "is_active": 1
+}
+
+
+class UserCache:
+    """Bounded LRU cache with a per-entry TTL, keyed by telegram_id.
+
+    Only touched from the event loop, so no locking is needed. Other workers
+    do not see invalidations, which the TTL bounds.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(value)
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, dict(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+user_cache = UserCache()
+
+
+async def get_cached_user(db, telegram_id):
+    """Resolve telegram_id to the cached hot fields, falling back to Mongo on a miss."""
+    user = user_cache.get(telegram_id)
+    if user is None:
+        user = await db.users.find_one({"telegram_id": telegram_id}, USER_CACHE_PROJECTION)
+        if user:
+            user_cache.set(telegram_id, user)
+    return user
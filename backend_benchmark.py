@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the GORA Dating App backend
+
+  seed     write a reproducible synthetic dataset straight into MongoDB
+  run      drive concurrent traffic at a server and record per-endpoint latency
+  compare  diff two result files and fail on latency or throughput regressions
+
+Typical local run against a throwaway database:
+
+  python backend_benchmark.py seed --users 5000 --drop
+  python backend_benchmark.py run --spawn-server --duration 30 --output before.json
+  ... change the code ...
+  python backend_benchmark.py run --spawn-server --duration 30 --output after.json
+  python backend_benchmark.py compare before.json after.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+DEFAULT_MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+DEFAULT_DB_NAME = os.environ.get('BENCHMARK_DB_NAME', 'dating_app_benchmark')
+DEFAULT_BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'http://localhost:8001')
+
+TELEGRAM_PREFIX = "bench_"
+SPOKY_IDS = list(range(1, 41))
+RELATIONSHIP_TYPES = ["serious", "casual", "friendship", "networking"]
+MESSAGE_WORDS = ["hi", "hey", "coffee", "tomorrow", "sounds", "good", "where", "are", "you", "from", "lol", "sure"]
+INSERT_BATCH = 1000
+
+# Relative weights of the read/write mix; override with --mix name=weight,...
+DEFAULT_MIX = {
+    "search": 30,
+    "search_ranked": 10,
+    "profile": 15,
+    "received_likes": 10,
+    "chats": 15,
+    "messages": 10,
+    "like": 5,
+    "send_message": 5,
+}
+
+
+def telegram_id_for(index):
+    return f"{TELEGRAM_PREFIX}{index}"
+
+
+# ---------------------------------------------------------------- seeding
+
+def generate_users(rng, count, now):
+    users = []
+    for i in range(count):
+        gender = rng.choice(["male", "female"])
+        users.append({
+            "user_id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "telegram_id": telegram_id_for(i),
+            "name": f"Bench {i}",
+            "age": rng.randint(18, 45),
+            "gender": gender,
+            "orientation": "straight",
+            "interested_in": ["female" if gender == "male" else "male"],
+            "relationship_type": rng.sample(RELATIONSHIP_TYPES, rng.randint(1, 2)),
+            "selected_spokies": rng.sample(SPOKY_IDS, rng.randint(3, 10)),
+            "profile_photos": [],
+            "profile_photo_variants": [],
+            "bio": "",
+            "tokens": 100,
+            "location": {"lat": None, "lng": None},
+            "created_at": now - timedelta(seconds=count - i),
+            "updated_at": now,
+            "is_active": True
+        })
+    return users
+
+
+def generate_activity(rng, users, likes_per_user, match_rate, messages_per_chat, now):
+    """Swipes between opposite-gender users; a share of likes are returned and become chats with history."""
+    by_gender = {"male": [], "female": []}
+    for user in users:
+        by_gender[user["gender"]].append(user["user_id"])
+
+    interactions = {}
+    for user in users:
+        pool = by_gender["female" if user["gender"] == "male" else "male"]
+        for target in rng.sample(pool, min(likes_per_user, len(pool))):
+            action = rng.choices(["like", "dislike", "super_like"], weights=[60, 35, 5])[0]
+            interactions[(user["user_id"], target)] = action
+
+    chats, messages = [], []
+    for (user_id, target), action in list(interactions.items()):
+        if action == "dislike" or (target, user_id) in interactions or rng.random() >= match_rate:
+            continue
+        interactions[(target, user_id)] = "like"
+
+        participants = [user_id, target]
+        chat_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        started = now - timedelta(minutes=rng.randint(messages_per_chat + 1, 60 * 24 * 30))
+        timestamp = started
+        for _ in range(messages_per_chat):
+            timestamp += timedelta(seconds=rng.randint(5, 600))
+            messages.append({
+                "message_id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "chat_id": chat_id,
+                "sender_id": rng.choice(participants),
+                "message": " ".join(rng.choices(MESSAGE_WORDS, k=rng.randint(1, 8))),
+                "timestamp": timestamp,
+                "is_read": True
+            })
+        chats.append({
+            "chat_id": chat_id,
+            "chat_key": ":".join(sorted(participants)),
+            "participants": participants,
+            "created_at": started,
+            "last_message": messages[-1]["message"] if messages_per_chat else None,
+            "last_message_time": timestamp
+        })
+
+    interaction_docs = [
+        {
+            "interaction_id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "user_id": user_id,
+            "target_user_id": target,
+            "action": action,
+            "timestamp": now - timedelta(seconds=rng.randint(0, 60 * 60 * 24 * 30))
+        }
+        for (user_id, target), action in interactions.items()
+    ]
+    return interaction_docs, chats, messages
+
+
+def insert_batched(collection, documents):
+    for start in range(0, len(documents), INSERT_BATCH):
+        collection.insert_many(documents[start:start + INSERT_BATCH], ordered=False)
+
+
+def seed(args):
+    from pymongo import MongoClient
+
+    rng = random.Random(args.seed)
+    now = datetime.now().replace(microsecond=0)
+
+    started = time.perf_counter()
+    users = generate_users(rng, args.users, now)
+    interactions, chats, messages = generate_activity(
+        rng, users, args.likes_per_user, args.match_rate, args.messages_per_chat, now
+    )
+    print(f"🧪 Generated {len(users)} users, {len(interactions)} interactions, "
+          f"{len(chats)} chats, {len(messages)} messages in {time.perf_counter() - started:.1f}s")
+
+    client = MongoClient(args.mongo_url)
+    db = client[args.db_name]
+    if args.drop:
+        client.drop_database(args.db_name)
+        print(f"🗑️ Dropped database {args.db_name}")
+
+    started = time.perf_counter()
+    for name, documents in (("users", users), ("interactions", interactions), ("chats", chats), ("messages", messages)):
+        insert_batched(db[name], documents)
+    print(f"✅ Seeded {args.db_name} in {time.perf_counter() - started:.1f}s")
+    client.close()
+    return 0
+
+
+# ---------------------------------------------------------------- load
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        for part in text.split(","):
+            name, _, weight = part.partition("=")
+            if name not in DEFAULT_MIX:
+                raise SystemExit(f"Unknown endpoint in --mix: {name}")
+            mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+class LoadRunner:
+    """Closed-loop load: every worker thread issues its next request as soon as the last one returns."""
+
+    def __init__(self, base_url, user_count, mix, seed, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.user_count = user_count
+        self.mix = mix
+        self.seed = seed
+        self.timeout = timeout
+        self.samples = {name: [] for name in mix}
+        self.errors = {name: 0 for name in mix}
+        self.chats_by_user = {}
+        self.targets_by_user = {}
+        self.lock = threading.Lock()
+
+    def discover(self, session, sample):
+        """Find chats and swipe targets through the API, so the run needs no database access."""
+        for index in sample:
+            telegram_id = telegram_id_for(index)
+            response = session.get(f"{self.base_url}/api/chats/{telegram_id}", params={"limit": 5}, timeout=self.timeout)
+            if response.status_code == 200:
+                chat_ids = [chat["chat_id"] for chat in response.json().get("chats", [])]
+                if chat_ids:
+                    self.chats_by_user[telegram_id] = chat_ids
+            if "like" in self.mix:
+                response = session.get(
+                    f"{self.base_url}/api/search/users", params={"telegram_id": telegram_id, "limit": 20}, timeout=self.timeout
+                )
+                if response.status_code == 200:
+                    user_ids = [user["user_id"] for user in response.json().get("users", [])]
+                    if user_ids:
+                        self.targets_by_user[telegram_id] = user_ids
+
+    def _request(self, session, rng, name):
+        """Issue one request for the named endpoint; returns the response, or None if it does not apply."""
+        telegram_id = telegram_id_for(rng.randrange(self.user_count))
+        url = self.base_url
+
+        if name in ("messages", "send_message"):
+            if not self.chats_by_user:
+                return None
+            telegram_id = rng.choice(list(self.chats_by_user))
+            chat_id = rng.choice(self.chats_by_user[telegram_id])
+            if name == "messages":
+                return session.get(f"{url}/api/chats/{chat_id}/messages", params={"latest": "true", "limit": 50}, timeout=self.timeout)
+            return session.post(
+                f"{url}/api/chats/{chat_id}/messages",
+                params={"telegram_id": telegram_id},
+                json={"chat_id": chat_id, "message": "benchmark"},
+                timeout=self.timeout
+            )
+        if name == "search":
+            return session.get(f"{url}/api/search/users", params={"telegram_id": telegram_id, "limit": 20}, timeout=self.timeout)
+        if name == "search_ranked":
+            return session.get(f"{url}/api/search/users", params={"telegram_id": telegram_id, "limit": 20, "rank": "true"}, timeout=self.timeout)
+        if name == "profile":
+            return session.get(f"{url}/api/profile/{telegram_id}", timeout=self.timeout)
+        if name == "received_likes":
+            return session.get(f"{url}/api/likes/received/{telegram_id}", params={"limit": 20}, timeout=self.timeout)
+        if name == "chats":
+            return session.get(f"{url}/api/chats/{telegram_id}", params={"limit": 20}, timeout=self.timeout)
+        if name == "like":
+            # Swipe on someone the search page actually showed this user
+            if not self.targets_by_user:
+                return None
+            telegram_id = rng.choice(list(self.targets_by_user))
+            return session.post(
+                f"{url}/api/like",
+                params={"telegram_id": telegram_id},
+                json={"target_user_id": rng.choice(self.targets_by_user[telegram_id]), "action": rng.choice(["like", "dislike"])},
+                timeout=self.timeout
+            )
+        raise ValueError(name)
+
+    def _worker(self, worker_id, deadline, remaining):
+        rng = random.Random(self.seed * 1000003 + worker_id)
+        names, weights = list(self.mix), list(self.mix.values())
+        session = requests.Session()
+        samples = {name: [] for name in names}
+        errors = {name: 0 for name in names}
+
+        while time.perf_counter() < deadline:
+            if remaining is not None:
+                with self.lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                response = self._request(session, rng, name)
+                if response is None:
+                    continue
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if ok:
+                samples[name].append(elapsed_ms)
+            else:
+                errors[name] += 1
+
+        session.close()
+        with self.lock:
+            for name in names:
+                self.samples[name].extend(samples[name])
+                self.errors[name] += errors[name]
+
+    def run(self, concurrency, duration, total_requests, warmup):
+        session = requests.Session()
+        sample = random.Random(self.seed).sample(range(self.user_count), min(self.user_count, 200))
+        self.discover(session, sample)
+        session.close()
+
+        if warmup:
+            self._worker(-1, time.perf_counter() + warmup, None)
+            self.samples = {name: [] for name in self.mix}
+            self.errors = {name: 0 for name in self.mix}
+
+        remaining = [total_requests] if total_requests else None
+        started = time.perf_counter()
+        deadline = started + duration if duration else float("inf")
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for worker_id in range(concurrency):
+                pool.submit(self._worker, worker_id, deadline, remaining)
+        return time.perf_counter() - started
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for name in self.mix:
+            latencies = sorted(self.samples[name])
+            count = len(latencies)
+            endpoints[name] = {
+                "requests": count,
+                "errors": self.errors[name],
+                "rps": round(count / elapsed, 2) if elapsed else 0.0,
+                "mean_ms": round(sum(latencies) / count, 2) if count else None,
+                "p50_ms": _round(percentile(latencies, 50)),
+                "p95_ms": _round(percentile(latencies, 95)),
+                "p99_ms": _round(percentile(latencies, 99)),
+                "max_ms": _round(latencies[-1] if latencies else None),
+            }
+        total = sum(e["requests"] for e in endpoints.values())
+        return {
+            "total_requests": total,
+            "total_errors": sum(e["errors"] for e in endpoints.values()),
+            "rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "endpoints": endpoints
+        }
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args):
+    """Run uvicorn from backend/ against the benchmark database and wait until it answers."""
+    env = dict(os.environ, MONGO_URL=args.mongo_url, MONGO_DB_NAME=args.db_name)
+    port = args.base_url.rstrip("/").rsplit(":", 1)[-1]
+    command = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", port,
+               "--workers", str(args.server_workers), "--log-level", "warning"]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(f"{args.base_url}/api/health", timeout=1).status_code == 200:
+                print(f"🚀 Server started (pid {process.pid})")
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("Server did not become healthy within 60s")
+
+
+def print_summary(summary):
+    print(f"{'endpoint':<16}{'req':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in summary["endpoints"].items():
+        print(f"{name:<16}{stats['requests']:>8}{stats['errors']:>6}{stats['rps']:>9}"
+              f"{_fmt(stats['p50_ms'])}{_fmt(stats['p95_ms'])}{_fmt(stats['p99_ms'])}")
+    print(f"📊 {summary['total_requests']} requests, {summary['total_errors']} errors, {summary['rps']} req/s")
+
+
+def _fmt(value):
+    return f"{value:>9.1f}" if value is not None else f"{'-':>9}"
+
+
+def run(args):
+    if not args.duration and not args.requests:
+        raise SystemExit("Give --duration or --requests")
+
+    server = start_server(args) if args.spawn_server else None
+    try:
+        runner = LoadRunner(args.base_url, args.users, parse_mix(args.mix), args.seed, args.timeout)
+        print(f"🔧 {args.concurrency} workers against {args.base_url}")
+        elapsed = runner.run(args.concurrency, args.duration, args.requests, args.warmup)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    summary = runner.summary(elapsed)
+    print_summary(summary)
+
+    if args.output:
+        result = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(),
+                "git_revision": git_revision(),
+                "base_url": args.base_url,
+                "concurrency": args.concurrency,
+                "duration_s": round(elapsed, 2),
+                "users": args.users,
+                "seed": args.seed,
+                "mix": runner.mix
+            },
+            **summary
+        }
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+        print(f"💾 Results written to {args.output}")
+    return 1 if summary["total_errors"] and args.fail_on_errors else 0
+
+
+# ---------------------------------------------------------------- compare
+
+def compare(args):
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+
+    gated = set(args.gate.split(","))
+    regressions = []
+    print(f"{'endpoint':<16}{'metric':<8}{'baseline':>10}{'candidate':>11}{'change':>9}")
+    for name, before in baseline["endpoints"].items():
+        after = candidate["endpoints"].get(name)
+        if not after:
+            continue
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("p99_ms", True), ("rps", False)):
+            old, new = before.get(metric), after.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = change > args.threshold if higher_is_worse else change < -args.threshold
+            marker = " ⚠️" if worse else ""
+            print(f"{name:<16}{metric:<8}{old:>10}{new:>11}{change:>+8.1f}%{marker}")
+            if worse and metric in gated:
+                regressions.append(f"{name} {metric} {change:+.1f}%")
+
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) over {args.threshold}%: {', '.join(regressions)}")
+        return 1
+    print("🎉 No regressions over the threshold")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GORA backend against a local MongoDB")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="write a synthetic dataset")
+    seed_parser.add_argument("--mongo-url", default=DEFAULT_MONGO_URL)
+    seed_parser.add_argument("--db-name", default=DEFAULT_DB_NAME)
+    seed_parser.add_argument("--users", type=int, default=5000)
+    seed_parser.add_argument("--likes-per-user", type=int, default=50)
+    seed_parser.add_argument("--match-rate", type=float, default=0.1, help="share of likes that are returned")
+    seed_parser.add_argument("--messages-per-chat", type=int, default=30)
+    seed_parser.add_argument("--seed", type=int, default=42)
+    seed_parser.add_argument("--drop", action="store_true", help="drop the benchmark database first")
+    seed_parser.set_defaults(handler=seed)
+
+    run_parser = commands.add_parser("run", help="generate load and record latency")
+    run_parser.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    run_parser.add_argument("--users", type=int, default=5000, help="number of seeded users to act as")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds; 0 to stop on --requests")
+    run_parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    run_parser.add_argument("--warmup", type=float, default=5, help="seconds of unrecorded traffic first")
+    run_parser.add_argument("--timeout", type=float, default=10)
+    run_parser.add_argument("--mix", default="", help="endpoint weights, e.g. search=50,like=0")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--output", help="write JSON results here")
+    run_parser.add_argument("--fail-on-errors", action="store_true")
+    run_parser.add_argument("--spawn-server", action="store_true", help="start uvicorn on --base-url's port")
+    run_parser.add_argument("--server-workers", type=int, default=1)
+    run_parser.add_argument("--mongo-url", default=DEFAULT_MONGO_URL)
+    run_parser.add_argument("--db-name", default=DEFAULT_DB_NAME)
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser("compare", help="diff two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=10, help="allowed change in percent")
+    compare_parser.add_argument("--gate", default="p95_ms,rps", help="metrics that fail the comparison")
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,7 @@ import requests
 import sys
 import json
 import os
+import subprocess
 from datetime import datetime
 from io import BytesIO
 from PIL import Image
@@ -52,6 +53,44 @@ class GoraAPITester:
         except Exception as e:
             return self.log_test("Health Check", False, f"Error: {str(e)}")
 
+    def test_health_probes(self):
+        """Test liveness and readiness probes"""
+        try:
+            live = requests.get(f"{self.base_url}/api/health/live", timeout=10)
+            ready = requests.get(f"{self.base_url}/api/health/ready", timeout=10)
+            success = live.status_code == 200 and ready.status_code == 200
+            details = f"Live: {live.status_code}, Ready: {ready.status_code}"
+            if ready.status_code in (200, 503):
+                data = ready.json()
+                success = success and data.get("status") == "ready" and "pool" in data
+                details += f", Checks: {data.get('checks')}, In flight: {data.get('in_flight_requests')}"
+            return self.log_test("Health Probes", success, details)
+        except Exception as e:
+            return self.log_test("Health Probes", False, f"Error: {str(e)}")
+
+    def test_cache_stats(self):
+        """Test user cache statistics endpoint"""
+        try:
+            response = requests.get(f"{self.base_url}/api/cache/stats", timeout=10)
+            success = response.status_code == 200
+            details = f"Status: {response.status_code}"
+            if success:
+                stats = response.json().get('user_cache', {})
+                details += f", Hits: {stats.get('hits', 'N/A')}, Misses: {stats.get('misses', 'N/A')}"
+            return self.log_test("Cache Stats", success, details)
+        except Exception as e:
+            return self.log_test("Cache Stats", False, f"Error: {str(e)}")
+
+    def test_metrics(self):
+        """Test the Prometheus metrics endpoint"""
+        try:
+            response = requests.get(f"{self.base_url}/api/metrics", timeout=10)
+            success = response.status_code == 200 and "gora_http_request_duration_seconds" in response.text
+            details = f"Status: {response.status_code}, Lines: {len(response.text.splitlines())}"
+            return self.log_test("Metrics", success, details)
+        except Exception as e:
+            return self.log_test("Metrics", False, f"Error: {str(e)}")
+
     def test_user_registration(self):
         """Test user registration with form data and file upload"""
         try:
@@ -126,6 +165,33 @@ class GoraAPITester:
         except Exception as e:
             return self.log_test("Get User Profile", False, f"Error: {str(e)}")
 
+    def test_get_user_profile_fields(self):
+        """Test narrowing the profile response with fields="""
+        try:
+            response = requests.get(
+                f"{self.base_url}/api/profile/{self.test_telegram_id}",
+                params={'fields': 'name,age'},
+                timeout=10
+            )
+
+            success = response.status_code == 200 and set(response.json()) == {'name', 'age'}
+            details = f"Status: {response.status_code}"
+            if response.status_code == 200:
+                details += f", Keys: {sorted(response.json())}"
+
+            invalid = requests.get(
+                f"{self.base_url}/api/profile/{self.test_telegram_id}",
+                params={'fields': 'no_such_field'},
+                timeout=10
+            )
+            success = success and invalid.status_code == 400
+            details += f", Unknown field status: {invalid.status_code}"
+
+            return self.log_test("Get User Profile Fields", success, details)
+
+        except Exception as e:
+            return self.log_test("Get User Profile Fields", False, f"Error: {str(e)}")
+
     def test_update_user_profile(self):
         """Test updating user profile"""
         try:
@@ -160,6 +226,35 @@ class GoraAPITester:
         except Exception as e:
             return self.log_test("Update User Profile", False, f"Error: {str(e)}")
 
+    def test_update_user_location(self):
+        """Test updating user location and searching nearby users"""
+        try:
+            response = requests.put(
+                f"{self.base_url}/api/profile/{self.test_telegram_id}/location",
+                json={"lat": 50.4501, "lng": 30.5234},
+                headers={'Content-Type': 'application/json'},
+                timeout=10
+            )
+
+            success = response.status_code == 200
+            details = f"Status: {response.status_code}"
+
+            if success:
+                response = requests.get(
+                    f"{self.base_url}/api/search/users",
+                    params={'telegram_id': self.test_telegram_id, 'max_distance_km': 50},
+                    timeout=10
+                )
+                success = response.status_code == 200
+                details += f", Nearby search status: {response.status_code}"
+                if success:
+                    details += f", Found {len(response.json().get('users', []))} nearby users"
+
+            return self.log_test("Update User Location", success, details)
+
+        except Exception as e:
+            return self.log_test("Update User Location", False, f"Error: {str(e)}")
+
     def test_search_users(self):
         """Test searching for users"""
         try:
@@ -232,6 +327,149 @@ class GoraAPITester:
         except Exception as e:
             return self.log_test("Like Functionality", False, f"Error: {str(e)}")
 
+    def test_batch_like(self):
+        """Test batch swipe endpoint"""
+        try:
+            batch_data = {
+                "actions": [
+                    {"target_user_id": "dummy_batch_target_1", "action": "like"},
+                    {"target_user_id": "dummy_batch_target_2", "action": "dislike"},
+                    {"target_user_id": "dummy_batch_target_1", "action": "like"}
+                ]
+            }
+
+            response = requests.post(
+                f"{self.base_url}/api/like/batch",
+                params={'telegram_id': self.test_telegram_id},
+                json=batch_data,
+                headers={'Content-Type': 'application/json'},
+                timeout=10
+            )
+
+            success = response.status_code == 200
+            details = f"Status: {response.status_code}"
+
+            if success:
+                results = response.json().get('results', [])
+                success = len(results) == len(batch_data["actions"])
+                details += f", Results: {len(results)}, Matches: {sum(1 for r in results if r.get('is_match'))}"
+            else:
+                try:
+                    error_data = response.json()
+                    details += f", Error: {error_data.get('detail', 'Unknown error')}"
+                except:
+                    details += f", Raw response: {response.text[:100]}"
+
+            return self.log_test("Batch Like", success, details)
+
+        except Exception as e:
+            return self.log_test("Batch Like", False, f"Error: {str(e)}")
+
+    def test_like_rate_limit(self):
+        """Test that spending the like budget returns 429 with Retry-After"""
+        try:
+            telegram_id = f"{self.test_telegram_id}_ratelimit"
+            self.register_user(telegram_id, 'Rate Limit User', 'male', ['female'])
+
+            # Each action in a batch costs one like token
+            batch_data = {
+                "actions": [
+                    {"target_user_id": f"dummy_rate_limit_target_{i}", "action": "dislike"}
+                    for i in range(50)
+                ]
+            }
+
+            response = None
+            for _ in range(20):
+                response = requests.post(
+                    f"{self.base_url}/api/like/batch",
+                    params={'telegram_id': telegram_id},
+                    json=batch_data,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=10
+                )
+                if response.status_code != 200:
+                    break
+
+            retry_after = response.headers.get('Retry-After', '')
+            success = (
+                response.status_code == 429
+                and retry_after.isdigit()
+                and int(retry_after) >= 1
+            )
+            details = f"Status: {response.status_code}, Retry-After: {retry_after or 'missing'}"
+            return self.log_test("Like Rate Limit", success, details)
+
+        except Exception as e:
+            return self.log_test("Like Rate Limit", False, f"Error: {str(e)}")
+
+    def register_user(self, telegram_id, name, gender, interested_in):
+        """Register a throwaway user and return its user_id"""
+        form_data = {
+            'telegram_id': telegram_id,
+            'name': name,
+            'age': '25',
+            'gender': gender,
+            'orientation': 'hetero',
+            'interested_in': json.dumps(interested_in),
+            'relationship_type': json.dumps(['seriousIntentions']),
+            'selectedSpokies': json.dumps([1, 2, 3]),
+            'bio': 'Test bio for dating app'
+        }
+        files = {'photos': ('test_photo.jpg', self.create_test_image(), 'image/jpeg')}
+        response = requests.post(f"{self.base_url}/api/auth/register", data=form_data, files=files, timeout=15)
+        response.raise_for_status()
+        profile = requests.get(f"{self.base_url}/api/profile/{telegram_id}", timeout=10)
+        profile.raise_for_status()
+        return profile.json()['user_id']
+
+    def like(self, telegram_id, target_user_id):
+        response = requests.post(
+            f"{self.base_url}/api/like",
+            params={'telegram_id': telegram_id},
+            json={"target_user_id": target_user_id, "action": "like"},
+            headers={'Content-Type': 'application/json'},
+            timeout=10
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def test_match_exactly_once(self):
+        """Test that repeated likes create exactly one chat for the pair"""
+        try:
+            liker_telegram_id = f"{self.test_telegram_id}_liker"
+            target_telegram_id = f"{self.test_telegram_id}_target"
+            liker_id = self.register_user(liker_telegram_id, 'Liker', 'male', ['female'])
+            target_id = self.register_user(target_telegram_id, 'Target', 'female', ['male'])
+
+            # A repeated like before the like-back must not match or create anything
+            first = self.like(liker_telegram_id, target_id)
+            repeat = self.like(liker_telegram_id, target_id)
+            like_back = self.like(target_telegram_id, liker_id)
+            # Liking again after the match reports the same match, not a new one
+            again = self.like(liker_telegram_id, target_id)
+            matches = [first['is_match'], repeat['is_match'], like_back['is_match'], again['is_match']]
+
+            chats = {}
+            for telegram_id, other_id in ((liker_telegram_id, target_id), (target_telegram_id, liker_id)):
+                response = requests.get(f"{self.base_url}/api/chats/{telegram_id}", timeout=10)
+                response.raise_for_status()
+                chats[telegram_id] = [
+                    chat['chat_id'] for chat in response.json().get('chats', []) if other_id in chat['participants']
+                ]
+
+            success = (
+                matches == [False, False, True, True]
+                and len(chats[liker_telegram_id]) == 1
+                and chats[liker_telegram_id] == chats[target_telegram_id]
+            )
+            details = f"is_match: {matches}, Chats: {len(chats[liker_telegram_id])}/{len(chats[target_telegram_id])}"
+
+            return self.log_test("Match Exactly Once", success, details)
+
+        except Exception as e:
+            return self.log_test("Match Exactly Once", False, f"Error: {str(e)}")
+
     def test_get_received_likes(self):
         """Test getting received likes"""
         try:
@@ -259,6 +497,32 @@ class GoraAPITester:
         except Exception as e:
             return self.log_test("Get Received Likes", False, f"Error: {str(e)}")
 
+    def test_get_received_likes_count(self):
+        """Test count-only mode for received likes"""
+        try:
+            response = requests.get(
+                f"{self.base_url}/api/likes/received/{self.test_telegram_id}",
+                params={'count_only': 'true'},
+                timeout=10
+            )
+
+            success = response.status_code == 200 and isinstance(response.json().get('count'), int)
+            details = f"Status: {response.status_code}"
+
+            if success:
+                details += f", Count: {response.json()['count']}"
+            else:
+                try:
+                    error_data = response.json()
+                    details += f", Error: {error_data.get('detail', 'Unknown error')}"
+                except:
+                    details += f", Raw response: {response.text[:100]}"
+
+            return self.log_test("Get Received Likes Count", success, details)
+
+        except Exception as e:
+            return self.log_test("Get Received Likes Count", False, f"Error: {str(e)}")
+
     def test_get_user_chats(self):
         """Test getting user chats"""
         try:
@@ -317,6 +581,292 @@ class GoraAPITester:
         except Exception as e:
             return self.log_test("Get Chat Messages", False, f"Error: {str(e)}")
 
+    def test_search_users_cursor(self):
+        """Test keyset pagination for search results"""
+        try:
+            response = requests.get(
+                f"{self.base_url}/api/search/users",
+                params={'telegram_id': self.test_telegram_id, 'limit': 1},
+                timeout=10
+            )
+
+            success = response.status_code == 200 and 'next_cursor' in response.json()
+            details = f"Status: {response.status_code}"
+
+            if success:
+                next_cursor = response.json()['next_cursor']
+                if next_cursor:
+                    response = requests.get(
+                        f"{self.base_url}/api/search/users",
+                        params={'telegram_id': self.test_telegram_id, 'limit': 1, 'cursor': next_cursor},
+                        timeout=10
+                    )
+                    success = response.status_code == 200
+                    details += f", Second page status: {response.status_code}"
+                else:
+                    details += ", Single page of results"
+
+            return self.log_test("Search Users Cursor", success, details)
+
+        except Exception as e:
+            return self.log_test("Search Users Cursor", False, f"Error: {str(e)}")
+
+    def test_chat_messages_latest(self):
+        """Test loading chat history backwards from the newest message"""
+        try:
+            response = requests.get(
+                f"{self.base_url}/api/chats/dummy_chat_id/messages",
+                params={'latest': 'true', 'limit': 20},
+                timeout=10
+            )
+
+            success = response.status_code == 200
+            details = f"Status: {response.status_code}"
+
+            if success:
+                data = response.json()
+                details += f", Found {len(data.get('messages', []))} messages, Cursor: {data.get('next_cursor')}"
+
+            invalid = requests.get(
+                f"{self.base_url}/api/chats/dummy_chat_id/messages",
+                params={'cursor': 'not-a-cursor'},
+                timeout=10
+            )
+            success = success and invalid.status_code == 400
+            details += f", Invalid cursor status: {invalid.status_code}"
+
+            return self.log_test("Get Chat Messages Latest", success, details)
+
+        except Exception as e:
+            return self.log_test("Get Chat Messages Latest", False, f"Error: {str(e)}")
+
+    def create_chat(self, suffix):
+        """Match two throwaway users; returns (sender telegram_id, reader telegram_id, chat)"""
+        sender_telegram_id = f"{self.test_telegram_id}_{suffix}_sender"
+        reader_telegram_id = f"{self.test_telegram_id}_{suffix}_reader"
+        sender_id = self.register_user(sender_telegram_id, 'Sender', 'male', ['female'])
+        reader_id = self.register_user(reader_telegram_id, 'Reader', 'female', ['male'])
+        self.like(sender_telegram_id, reader_id)
+        self.like(reader_telegram_id, sender_id)
+        response = requests.get(f"{self.base_url}/api/chats/{sender_telegram_id}", timeout=10)
+        response.raise_for_status()
+        chat = next(chat for chat in response.json()['chats'] if reader_id in chat['participants'])
+        return sender_telegram_id, reader_telegram_id, chat
+
+    def get_chat(self, telegram_id, chat_id):
+        response = requests.get(f"{self.base_url}/api/chats/{telegram_id}", timeout=10)
+        response.raise_for_status()
+        return next(chat for chat in response.json()['chats'] if chat['chat_id'] == chat_id)
+
+    def send_messages(self, telegram_id, chat_id, texts):
+        for text in texts:
+            response = requests.post(
+                f"{self.base_url}/api/chats/{chat_id}/messages",
+                params={'telegram_id': telegram_id},
+                json={"chat_id": chat_id, "message": text},
+                timeout=10
+            )
+            response.raise_for_status()
+
+    def read_history(self, chat_id, page_size=3):
+        """Read a chat both ways with cursors; returns (forward, backward) messages, oldest first"""
+        forward = []
+        params = {'limit': page_size}
+        while True:
+            response = requests.get(f"{self.base_url}/api/chats/{chat_id}/messages", params=params, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+            if not data['messages']:
+                break
+            forward += data['messages']
+            params = {'cursor': data['next_cursor'], 'limit': page_size}
+
+        backward = []
+        params = {'latest': 'true', 'limit': page_size}
+        while True:
+            response = requests.get(f"{self.base_url}/api/chats/{chat_id}/messages", params=params, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+            backward = data['messages'] + backward
+            if not data['next_cursor']:
+                break
+            params = {'cursor': data['next_cursor'], 'limit': page_size}
+        return forward, backward
+
+    def check_history(self, reader_telegram_id, chat_id, texts):
+        """Check paging both ways and mark-read against the texts sent; returns (ok, details)"""
+        forward, backward = self.read_history(chat_id)
+        ok = [m['message'] for m in forward] == texts and [m['message'] for m in backward] == texts
+        details = f"Forward: {len(forward)}, Backward: {len(backward)} of {len(texts)}"
+
+        response = requests.post(
+            f"{self.base_url}/api/chats/{chat_id}/read",
+            params={'telegram_id': reader_telegram_id},
+            json={},
+            timeout=10
+        )
+        response.raise_for_status()
+        marked = response.json()['marked']
+        unread = requests.get(f"{self.base_url}/api/chats/{reader_telegram_id}/unread", timeout=10).json()
+        forward, _ = self.read_history(chat_id)
+        ok = ok and unread['unread_total'] == 0 and all(m['is_read'] for m in forward)
+        details += f", Marked: {marked}, Unread after: {unread['unread_total']}"
+        return ok, details
+
+    def test_chat_messages_paging(self):
+        """Test cursor paging, latest and mark-read on a real chat in the server's storage mode"""
+        try:
+            sender, reader, chat = self.create_chat("paging")
+            texts = [f"message {i}" for i in range(7)]
+            self.send_messages(sender, chat['chat_id'], texts)
+
+            success, details = self.check_history(reader, chat['chat_id'], texts)
+            details = f"Storage: {chat.get('storage', 'documents')}, {details}"
+
+            return self.log_test("Chat Messages Paging", success, details)
+
+        except Exception as e:
+            return self.log_test("Chat Messages Paging", False, f"Error: {str(e)}")
+
+    def test_message_storage_conversion(self):
+        """Test converting a chat to bucketed storage with message_store.py, then reading and writing it"""
+        try:
+            sender, reader, chat = self.create_chat("convert")
+            texts = [f"before {i}" for i in range(5)]
+            self.send_messages(sender, chat['chat_id'], texts)
+            before, _ = self.read_history(chat['chat_id'])
+
+            # Runs against the same database as the server, from its MONGO_URL/DB_NAME;
+            # nothing else writes to this chat, so no grace period is needed
+            result = subprocess.run(
+                [sys.executable, 'message_store.py', '--chat', chat['chat_id']],
+                cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'),
+                env={**os.environ, 'MESSAGE_MIGRATION_GRACE': '0'},
+                capture_output=True,
+                text=True,
+                timeout=60
+            )
+            converted = self.get_chat(sender, chat['chat_id'])
+            after, _ = self.read_history(chat['chat_id'])
+            success = (
+                result.returncode == 0
+                and converted.get('storage') == 'bucketed'
+                and [m['message_id'] for m in after] == [m['message_id'] for m in before]
+            )
+            details = f"Exit: {result.returncode}, {result.stdout.strip() or result.stderr.strip()[-100:]}"
+            details += f", Storage: {chat.get('storage', 'documents')} -> {converted.get('storage', 'documents')}"
+
+            # New messages now go to the buckets, after the converted history
+            texts += [f"after {i}" for i in range(3)]
+            self.send_messages(sender, chat['chat_id'], texts[5:])
+            ok, history_details = self.check_history(reader, chat['chat_id'], texts)
+            success = success and ok
+            details += f", {history_details}"
+
+            return self.log_test("Message Storage Conversion", success, details)
+
+        except Exception as e:
+            return self.log_test("Message Storage Conversion", False, f"Error: {str(e)}")
+
+    def test_mark_chat_read(self):
+        """Test that marking a chat read is refused for non-participants"""
+        try:
+            response = requests.post(
+                f"{self.base_url}/api/chats/dummy_chat_id/read",
+                params={'telegram_id': self.test_telegram_id},
+                json={},
+                timeout=10
+            )
+
+            # The dummy chat does not exist, so the request must be rejected
+            success = response.status_code == 403
+            details = f"Status: {response.status_code}"
+
+            return self.log_test("Mark Chat Read", success, details)
+
+        except Exception as e:
+            return self.log_test("Mark Chat Read", False, f"Error: {str(e)}")
+
+    def test_unread_total(self):
+        """Test the unread badge total across all chats"""
+        try:
+            response = requests.get(
+                f"{self.base_url}/api/chats/{self.test_telegram_id}/unread",
+                timeout=10
+            )
+
+            success = response.status_code == 200
+            details = f"Status: {response.status_code}"
+
+            if success:
+                data = response.json()
+                details += f", Unread: {data.get('unread_total')} in {data.get('unread_chats')} chats"
+
+            return self.log_test("Get Unread Total", success, details)
+
+        except Exception as e:
+            return self.log_test("Get Unread Total", False, f"Error: {str(e)}")
+
+    def profile_photo_url(self):
+        """Return the absolute URL of the test user's first photo"""
+        response = requests.get(f"{self.base_url}/api/profile/{self.test_telegram_id}", timeout=10)
+        response.raise_for_status()
+        return f"{self.base_url}{response.json()['profile_photos'][0]}"
+
+    def test_photo_cache_headers(self):
+        """Test that content-hashed photos are served as immutable with an ETag"""
+        try:
+            response = requests.get(self.profile_photo_url(), timeout=10)
+            cache_control = response.headers.get('Cache-Control', '')
+            success = (
+                response.status_code == 200
+                and 'immutable' in cache_control
+                and 'max-age=31536000' in cache_control
+                and bool(response.headers.get('ETag'))
+            )
+            details = f"Status: {response.status_code}, Cache-Control: {cache_control}, ETag: {response.headers.get('ETag')}"
+            return self.log_test("Photo Cache Headers", success, details)
+        except Exception as e:
+            return self.log_test("Photo Cache Headers", False, f"Error: {str(e)}")
+
+    def test_photo_not_modified(self):
+        """Test that a matching If-None-Match returns 304 without a body"""
+        try:
+            photo_url = self.profile_photo_url()
+            etag = requests.get(photo_url, timeout=10).headers.get('ETag')
+            response = requests.get(photo_url, headers={'If-None-Match': etag}, timeout=10)
+            success = bool(etag) and response.status_code == 304 and not response.content
+            details = f"Status: {response.status_code}, ETag: {etag}"
+            return self.log_test("Photo Not Modified", success, details)
+        except Exception as e:
+            return self.log_test("Photo Not Modified", False, f"Error: {str(e)}")
+
+    def test_photo_range(self):
+        """Test Range requests: 206 for a satisfiable range, 416 past the end"""
+        try:
+            photo_url = self.profile_photo_url()
+            size = len(requests.get(photo_url, timeout=10).content)
+
+            partial = requests.get(photo_url, headers={'Range': 'bytes=0-9'}, timeout=10)
+            success = (
+                partial.status_code == 206
+                and partial.headers.get('Content-Range') == f"bytes 0-9/{size}"
+                and len(partial.content) == 10
+            )
+            details = f"Partial: {partial.status_code} {partial.headers.get('Content-Range')}"
+
+            unsatisfiable = requests.get(photo_url, headers={'Range': f"bytes={size}-"}, timeout=10)
+            success = (
+                success
+                and unsatisfiable.status_code == 416
+                and unsatisfiable.headers.get('Content-Range') == f"bytes */{size}"
+            )
+            details += f", Past end: {unsatisfiable.status_code} {unsatisfiable.headers.get('Content-Range')}"
+
+            return self.log_test("Photo Range", success, details)
+        except Exception as e:
+            return self.log_test("Photo Range", False, f"Error: {str(e)}")
+
     def run_all_tests(self):
         """Run all API tests"""
         print("🚀 Starting GORA Dating App Backend API Tests")
@@ -327,14 +877,32 @@ class GoraAPITester:
         # Run tests in logical order
         tests = [
             self.test_health_check,
+            self.test_health_probes,
             self.test_user_registration,
             self.test_get_user_profile,
+            self.test_get_user_profile_fields,
+            self.test_photo_cache_headers,
+            self.test_photo_not_modified,
+            self.test_photo_range,
             self.test_update_user_profile,
+            self.test_update_user_location,
             self.test_search_users,
+            self.test_search_users_cursor,
             self.test_like_functionality,
+            self.test_batch_like,
+            self.test_match_exactly_once,
             self.test_get_received_likes,
+            self.test_get_received_likes_count,
             self.test_get_user_chats,
             self.test_chat_messages,
+            self.test_chat_messages_latest,
+            self.test_mark_chat_read,
+            self.test_chat_messages_paging,
+            self.test_message_storage_conversion,
+            self.test_unread_total,
+            self.test_cache_stats,
+            self.test_metrics,
+            self.test_like_rate_limit,
         ]
 
         for test in tests:
@@ -112,8 +112,16 @@ export const sendLike = async (telegramId, targetUserId, action) => {
 
 export const getReceivedLikes = async (telegramId) => {
   try {
-    const response = await api.get(`/api/likes/received/${telegramId}`);
-    return response.data;
+    // The endpoint is paged; follow the cursor so the likes page still gets the full list
+    const likes = [];
+    let cursor = null;
+    do {
+      const cursorParam = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await api.get(`/api/likes/received/${telegramId}?limit=100${cursorParam}`);
+      likes.push(...response.data.likes);
+      cursor = response.data.next_cursor;
+    } while (cursor);
+    return { likes, next_cursor: null };
   } catch (error) {
     console.error("❌ Get received likes error:", error.response ? error.response.data : error.message);
     throw error;